@@ -0,0 +1,258 @@
+USAGE = """USAGE
+
+$ python benchmarks/bench.py [--quick] [--only name,...] [--out results.json] [--compare old.json]
+
+Runs fixed-seed workloads through the numerical and rendering hot paths and
+reports, for each stage, the best wall time, the peak traced memory and the
+items (frames, slices, pixels, ...) per second. Results are saved as JSON,
+named after the current commit unless [--out] is given.
+
+[--quick] runs the small sizes only
+
+[--only] runs only the named benchmarks, out of:
+    eig_trajectories, eig_loops, eigenvector_trajectories, render_eig,
+    pixel_coords, render_pixels, homotopy, sird
+
+[--compare] prints the time ratio of every stage to a previous results file
+
+Examples:
+
+    $ python benchmarks/bench.py --quick
+
+    $ python benchmarks/bench.py --only eig_loops,render_eig --compare bench-1a2b3c4.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)
+sys.path.append(ROOT)
+for package in ('eigenloops','pixelanimation','polyrootanimation','diseasemodel_interactive'):
+    sys.path.append(os.path.join(ROOT,package))
+
+SIZES = {
+    'quick': {'n':[10,50],'m':200,'grid':40,'resolution':[64],'frames':60,
+              'homotopy_grid':[100],'homotopy_frames':20,'ensemble':[100]},
+    'full':  {'n':[10,50,200],'m':1000,'grid':200,'resolution':[128,512],'frames':240,
+              'homotopy_grid':[200,800],'homotopy_frames':100,'ensemble':[100,10000]},
+}
+
+def measure(f,repeat=3):
+    """Runs f once under tracemalloc for its peak memory and `repeat` more
+    times for its best wall time"""
+    tracemalloc.start()
+    try:
+        f()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter()-start)
+    return min(times),peak
+
+def result(name,stage,params,f,items,repeat=3):
+    seconds,peak = measure(f,repeat)
+    return {'name':name,'stage':stage,'params':params,'seconds':seconds,
+            'peak_bytes':peak,'items':items,'items_per_second':items/seconds}
+
+def random_matrices(n,seed=0):
+    rng = np.random.default_rng(seed)
+    M1,M2,M3 = rng.standard_normal((3,n,n))+1j*rng.standard_normal((3,n,n))
+    return M1,M2,M3
+
+def bench_eig_trajectories(sizes,tmpdir):
+    import eigentools as et
+    for n in sizes['n']:
+        M1,M2,_ = random_matrices(n)
+        A = lambda t: M1+.1*np.exp(1j*t)[...,None,None]*M2
+        T = np.linspace(0,2*np.pi,sizes['m'])
+        for batched in (False,True):
+            for matching in ('greedy','optimal'):
+                params = {'n':n,'m':len(T),'batched':batched,'matching':matching}
+                yield result('eig_trajectories','compute',params,
+                             lambda: et.eig_trajectories(A,T,batched=batched,matching=matching),len(T))
+
+def bench_eig_loops(sizes,tmpdir):
+    import eigentools as et
+    for n in sizes['n']:
+        M1,M2,M3 = random_matrices(n)
+        A = lambda u,v: M1+.1*np.exp(1j*u)[...,None,None]*M2+.05*np.exp(1j*v)*M3
+        U = np.linspace(0,2*np.pi,sizes['grid'])
+        params = {'n':n,'grid':len(U)}
+        yield result('eig_loops','compute',params,
+                     lambda: et.eig_loops(A,U,U,batched=True),len(U),repeat=1)
+
+def bench_eigenvector_trajectories(sizes,tmpdir):
+    import eigentools as et
+    for n in sizes['n']:
+        M1,M2,_ = random_matrices(n)
+        A = lambda t: M1+.1*np.exp(1j*t)*M2
+        T = np.linspace(0,2*np.pi,sizes['m'])
+        for matching in ('greedy','overlap'):
+            params = {'n':n,'m':len(T),'matching':matching}
+            yield result('eigenvector_trajectories','compute',params,
+                         lambda: et.eigenvector_trajectories(A,T,matching=matching),len(T))
+
+def bench_render_eig(sizes,tmpdir):
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError("ffmpeg not found")
+    import eigentools as et
+    import eigenani as ea
+    n = sizes['n'][0]
+    M1,M2,_ = random_matrices(n)
+    A = lambda t: M1+.1*np.exp(1j*t)[...,None,None]*M2
+    E = et.eig_trajectories(A,np.linspace(0,2*np.pi,sizes['frames']),batched=True)
+    outfile = os.path.join(tmpdir,'eig.mp4')
+    for backend in ('matplotlib','pipe'):
+        params = {'n':n,'frames':E.shape[1],'backend':backend}
+        yield result('render_eig','render',params,
+                     lambda: ea.render_eig(E,outfile,backend=backend),E.shape[1],repeat=1)
+
+def bench_pixel_coords(sizes,tmpdir):
+    import pixelanimation as pa
+    rng = np.random.default_rng(0)
+    for r in sizes['resolution']:
+        gray,color = rng.random((r,r)),rng.random((r,r,3))
+        params = {'resolution':r}
+        yield result('grayscale_to_coords','compute',params,lambda: pa.grayscale_to_coords(gray),r*r)
+        yield result('color_to_coords','compute',params,lambda: pa.color_to_coords(color),r*r)
+        yield result('transport_coords','compute',params,lambda: pa.transport_coords(color,color[::-1]),r*r)
+
+def bench_render_pixels(sizes,tmpdir):
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError("ffmpeg not found")
+    import pixelanimation as pa
+    rng = np.random.default_rng(0)
+    frames = range(sizes['frames'])
+    outfile = os.path.join(tmpdir,'pixels.mp4')
+    for r in sizes['resolution']:
+        image1,image2 = rng.random((2,r,r,3))
+        coords1,coords2 = pa.color_to_coords(image1),pa.color_to_coords(image2)
+        for renderer in ('scatter','raster'):
+            for lazy in (False,True):
+                params = {'resolution':r,'frames':len(frames),'renderer':renderer,'lazy':lazy}
+                yield result('render_pixels','render',params,
+                             lambda: pa.render_pixels(coords1,coords2,image1.shape,image2.shape,outfile,
+                                                      color=True,frames=frames,lazy=lazy,renderer=renderer),
+                             len(frames),repeat=1)
+
+def bench_homotopy(sizes,tmpdir):
+    import polyrootanimation as pra
+    np.random.seed(0)
+    P,Q = pra.gen_polynomials(5,True)
+    T = np.linspace(0,1,sizes['homotopy_frames'])
+    for g in sizes['homotopy_grid']:
+        X,Y = np.meshgrid(np.linspace(-1,1,g),np.linspace(-1,1,g))
+        params = {'grid':g,'frames':len(T)}
+        yield result('eval_homotopy','compute',dict(params,solver='solve'),
+                     lambda: pra.eval_homotopy(P,Q,T,X,Y,mode='blend'),len(T),repeat=1)
+        yield result('eval_homotopy','compute',dict(params,solver='track'),
+                     lambda: pra.eval_homotopy(P,Q,T,X,Y,mode='blend',solver='track'),len(T),repeat=1)
+        arr1,arr2,roots,_ = pra.eval_homotopy(P,Q,T,X,Y,mode='blend')
+        yield result('zero_contours','contour',params,lambda: pra.zero_contours(X,Y,arr1),len(T))
+        if shutil.which('ffmpeg') is not None:
+            lines1,lines2 = pra.zero_contours(X,Y,arr1),pra.zero_contours(X,Y,arr2)
+            outfile = os.path.join(tmpdir,'homotopy.mp4')
+            yield result('render_homotopy','render',params,
+                         lambda: pra.render_homotopy(X,Y,lines1,lines2,roots,outfile),2*len(T),repeat=1)
+
+def bench_sird(sizes,tmpdir):
+    import SIRD
+    t_eval = np.arange(365.)
+    args = (.001,1.4/14,1/14,.01,.08,.005,.1)
+    def solve():
+        SIRD._SIRD.cache_clear()
+        SIRD.SIRD(t_eval,*args)
+    yield result('SIRD','compute',{'days':len(t_eval)},solve,1)
+    rng = np.random.default_rng(0)
+    for N in sizes['ensemble']:
+        params = [rng.uniform(lo,hi,N) for lo,hi in
+                  ((1e-4,1e-2),(.05,.3),(1/20,1/7),(.005,.02),(.03,.1),(.001,.01),(.05,.2))]
+        yield result('SIRD_ensemble','compute',{'days':len(t_eval),'N':N},
+                     lambda: SIRD.SIRD_ensemble(t_eval,*params),N)
+
+BENCHMARKS = {
+    'eig_trajectories':bench_eig_trajectories,
+    'eig_loops':bench_eig_loops,
+    'eigenvector_trajectories':bench_eigenvector_trajectories,
+    'render_eig':bench_render_eig,
+    'pixel_coords':bench_pixel_coords,
+    'render_pixels':bench_render_pixels,
+    'homotopy':bench_homotopy,
+    'sird':bench_sird,
+}
+
+def git_commit():
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],cwd=ROOT,capture_output=True,
+                              text=True,check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return 'unknown'
+
+def run(names,sizes):
+    """Runs the named benchmarks, printing each result as it comes. A
+    benchmark that cannot run here (e.g. a missing dependency) is recorded as
+    skipped."""
+    results,skipped = [],{}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in names:
+            try:
+                for r in BENCHMARKS[name](sizes,tmpdir):
+                    results.append(r)
+                    print(f"{r['name']:26s}{r['stage']:9s}{r['seconds']:10.4f}s"
+                          f"{r['peak_bytes']/2**20:10.1f}MB{r['items_per_second']:12.1f}/s  {r['params']}")
+            except Exception as e:
+                skipped[name] = f"{type(e).__name__}: {e}"
+                print(f"{name:26s}skipped  {skipped[name]}")
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors=True)
+    return results,skipped
+
+def compare(results,old):
+    """Prints the time ratio new/old of every stage present in both runs"""
+    key = lambda r: (r['name'],r['stage'],json.dumps(r['params'],sort_keys=True))
+    before = {key(r):r for r in old['results']}
+    print(f"\ncompared to {old['commit']}")
+    for r in results:
+        if key(r) in before:
+            print(f"{r['name']:26s}{r['stage']:9s}{r['seconds']/before[key(r)]['seconds']:8.2f}x  {r['params']}")
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    if "--help" in argv:
+        print(USAGE)
+        raise SystemExit(0)
+    sizes = SIZES['quick' if "--quick" in argv else 'full']
+    names = argv[argv.index("--only")+1].split(',') if "--only" in argv else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'\n")
+            print(USAGE)
+            raise SystemExit(1)
+
+    commit = git_commit()
+    results,skipped = run(names,sizes)
+    outfile = argv[argv.index("--out")+1] if "--out" in argv else f"bench-{commit}.json"
+    with open(outfile,'w') as f:
+        json.dump({'commit':commit,'date':time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python':platform.python_version(),'numpy':np.__version__,
+                   'machine':platform.machine(),'cpus':os.cpu_count(),
+                   'sizes':sizes,'results':results,'skipped':skipped},f,indent=1)
+    print(f"saved as {outfile}")
+    if "--compare" in argv:
+        with open(argv[argv.index("--compare")+1]) as f:
+            compare(results,json.load(f))
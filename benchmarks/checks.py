@@ -0,0 +1,174 @@
+USAGE = """USAGE
+
+$ python benchmarks/checks.py [--only name,...]
+
+Runs small correctness checks of behaviour the benchmarks rely on but do not
+verify, printing 'ok', 'FAILED' or 'skipped' (e.g. a missing dependency) for
+each. Exits with status 1 if any check failed.
+
+[--only] runs only the named checks, out of:
+    degenerate_stepping, crossing, function_key, resume_mismatch,
+    parallel_render
+
+Examples:
+
+    $ python benchmarks/checks.py
+
+    $ python benchmarks/checks.py --only degenerate_stepping
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import traceback
+import subprocess
+from functools import partial
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)
+sys.path.append(ROOT)
+for package in ('eigenloops','pixelanimation','polyrootanimation','diseasemodel_interactive'):
+    sys.path.append(os.path.join(ROOT,package))
+
+class Skip(Exception):
+    pass
+
+def check_degenerate_stepping(tmpdir):
+    """A repeated eigenvalue must not hold the adaptive step at hmin"""
+    import eigentools as et
+    solves = []
+    def A(t):
+        solves.append(t)
+        return np.diag([1.,1.,2.+t])
+    T,E = et.adaptive_eig_trajectories(A,0,1,tol=1e-2)
+    # the moving eigenvalue alone needs about 1/tol steps
+    assert len(solves) < 300, f"{len(solves)} solves"
+    assert T[-1] == 1 and np.allclose(np.sort(E[:,-1].real),[1,1,3])
+
+def check_crossing(tmpdir):
+    """Eigenvalues crossing each other must keep their trajectories"""
+    import eigentools as et
+    solves = []
+    def A(t):
+        solves.append(t)
+        return np.diag([t,1-t,.3])
+    T,E = et.adaptive_eig_trajectories(A,0,1,tol=1e-2)
+    assert len(solves) < 300, f"{len(solves)} solves"
+    assert np.allclose(E[:,-1].real,[1,0,.3]), f"ends at {E[:,-1].real}"
+
+def check_function_key(tmpdir):
+    """Callables closing over different values must have different keys, and
+    values the key cannot identify must raise"""
+    import scipy.sparse as sp
+    from eigenfun.cache import function_key
+    make = lambda f: (lambda t: f(t))
+    assert function_key(make(np.sin)) != function_key(make(np.cos))
+    assert function_key(make(lambda t: t)) != function_key(make(lambda t: 2*t))
+    assert function_key(make(np.sin)) == function_key(make(np.sin))
+    S = sp.eye(3)
+    A = lambda t: S.toarray()*t
+    try:
+        function_key(A)
+    except TypeError:
+        A.cache_key = ('A',S.toarray())
+        function_key(A)
+    else:
+        raise AssertionError("keyed a closure over a sparse matrix")
+
+def check_resume_mismatch(tmpdir):
+    """eig_loops must resume an outfile of the same arguments, refuse one of
+    different arguments and still stream an A it cannot identify"""
+    import eigentools as et
+    M1,M2 = np.random.default_rng(0).standard_normal((2,4,4))
+    A = lambda u,v: M1+np.cos(u)*M2+v*np.eye(4)
+    B = lambda u,v: M1+np.sin(u)*M2+v*np.eye(4)
+    U,V = np.linspace(0,1,5),np.linspace(0,1,3)
+    outfile = os.path.join(tmpdir,'loops.npy')
+    L = np.array(et.eig_loops(A,U,V,outfile=outfile))
+    assert np.array_equal(np.array(et.eig_loops(A,U,V,outfile=outfile)),L)
+    for args in ((B,U,V),(A,U+1,V),(A,U,V[::-1])):
+        try:
+            et.eig_loops(*args,outfile=outfile)
+        except ValueError:
+            continue
+        raise AssertionError("resumed with different arguments")
+    # an A the key cannot identify still streams and resumes, with a warning
+    import warnings
+    import scipy.sparse as sp
+    S = sp.diags(np.arange(4.))
+    C = lambda u,v: S.toarray()+np.cos(u)*M2+v*np.eye(4)
+    outfile = os.path.join(tmpdir,'sparse.npy')
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        L = np.array(et.eig_loops(C,U,V,outfile=outfile))
+        assert np.array_equal(np.array(et.eig_loops(C,U,V,outfile=outfile)),L)
+    assert caught, "no warning for an A that cannot be identified"
+
+def decode(video):
+    """The frames of a video decoded to raw rgb24 bytes"""
+    return subprocess.run(['ffmpeg','-loglevel','error','-i',video,'-f','rawvideo',
+                           '-pix_fmt','rgb24','-'],capture_output=True,check=True).stdout
+
+def check_parallel_render(tmpdir):
+    """Rendering in parallel segments must decode to the same frames as
+    rendering serially, with both backends, encoded lossily or not"""
+    if shutil.which('ffmpeg') is None:
+        raise Skip("ffmpeg not found")
+    import eigenani as ea
+    from eigenfun.segments import render_parallel
+    from eigenfun.framepipe import encoder_args
+    t = np.linspace(0,2*np.pi,24)
+    E = np.array([np.exp(1j*t),.5*np.exp(-2j*t),1+.3j*np.cos(t)])
+    for backend in ('pipe','matplotlib'):
+        for lossless in (False,True):
+            serial = os.path.join(tmpdir,f'serial-{backend}-{lossless}.mp4')
+            parallel = os.path.join(tmpdir,f'parallel-{backend}-{lossless}.mp4')
+            ea.render_eig(E,serial,backend=backend,lossless=lossless)
+            render_parallel(partial(ea.render_eig,E,backend=backend),E.shape[1],parallel,3,
+                            encode=None if lossless else encoder_args())
+            frames = decode(serial)
+            assert len(frames) > 0 and frames == decode(parallel), \
+                f"{backend} frames differ (lossless={lossless})"
+
+CHECKS = {
+    'degenerate_stepping': check_degenerate_stepping,
+    'crossing': check_crossing,
+    'function_key': check_function_key,
+    'resume_mismatch': check_resume_mismatch,
+    'parallel_render': check_parallel_render,
+}
+
+def run(names):
+    """Runs the named checks, returning the names of those that failed"""
+    failed = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in names:
+            try:
+                CHECKS[name](tmpdir)
+                print(f"{name:26s}ok")
+            except Skip as e:
+                print(f"{name:26s}skipped  {e}")
+            except Exception:
+                failed.append(name)
+                print(f"{name:26s}FAILED")
+                traceback.print_exc()
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors=True)
+    return failed
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    if "--help" in argv:
+        print(USAGE)
+        raise SystemExit(0)
+    names = argv[argv.index("--only")+1].split(',') if "--only" in argv else list(CHECKS)
+    for name in names:
+        if name not in CHECKS:
+            print(f"Unknown check '{name}'\n")
+            print(USAGE)
+            raise SystemExit(1)
+    raise SystemExit(1 if run(names) else 0)
@@ -1,20 +1,105 @@
 import numpy as np
+from functools import lru_cache
 from scipy.integrate import solve_ivp
-import matplotlib.pyplot as plt
-
-def SIRD(t_eval,I0,beta,gamma,delta1,delta2,K,severe):
-    y0 = np.array([1-I0,I0,0,0])
-    def func(t,y,beta,gamma,delta1,delta2,K,severe):
-        if severe*y[1] <= K:
-            return np.array([-beta*y[0]*y[1],beta*y[0]*y[1]-gamma*y[1],gamma*(1-delta1)*y[1],gamma*delta1*y[1]])
-        else:
-            frac = (delta1*K+delta2*(y[1]-K))/y[1]
-            return np.array([-beta*y[0]*y[1],beta*y[0]*y[1]-gamma*y[1],gamma*(1-frac)*y[1],gamma*frac*y[1]])
-    return solve_ivp(func,(t_eval[0],t_eval[-1]),y0,t_eval=t_eval,args=(beta,gamma,delta1,delta2,K,severe)).y
-
-def plot(I0,beta,gamma,delta1,delta2,K):
+
+def _func(t,y,beta,gamma,delta1,delta2,K,severe,over):
+    if not over:
+        return np.array([-beta*y[0]*y[1],beta*y[0]*y[1]-gamma*y[1],gamma*(1-delta1)*y[1],gamma*delta1*y[1]])
+    else:
+        frac = (delta1*K+delta2*(y[1]-K))/y[1]
+        return np.array([-beta*y[0]*y[1],beta*y[0]*y[1]-gamma*y[1],gamma*(1-frac)*y[1],gamma*frac*y[1]])
+
+@lru_cache(maxsize=1024)
+def _SIRD(t_eval,I0,beta,gamma,delta1,delta2,K,severe):
+    t_eval = np.array(t_eval)
+    params = (beta,gamma,delta1,delta2,K,severe)
+    y = np.empty((4,len(t_eval)))
+    t,y0 = t_eval[0],np.array([1-I0,I0,0,0])
+    over = severe*I0 > K
+    y[:,0] = y0
+    done = 1
+    # the severe cases crossing the capacity end a regime
+    def capacity(t,y,*args):
+        return severe*y[1]-K
+    capacity.terminal = True
+    # integrate each smooth regime up to the capacity crossing that ends it
+    while done < len(t_eval):
+        capacity.direction = -1 if over else 1
+        sol = solve_ivp(_func,(t,t_eval[-1]),y0,t_eval=t_eval[done:],events=capacity,
+                        args=params+(over,))
+        if sol.status == -1:
+            # raising keeps the incomplete solution out of the cache
+            raise RuntimeError(f"SIRD integration failed at t={sol.t[-1] if len(sol.t) else t}: {sol.message}")
+        y[:,done:done+len(sol.t)] = sol.y
+        done += len(sol.t)
+        if sol.status != 1:
+            break
+        t,y0 = sol.t_events[0][0],sol.y_events[0][0]
+        over = not over
+    y.setflags(write=False)
+    return y
+
+def SIRD(t_eval,I0,beta,gamma,delta1,delta2,K,severe,decimals=10):
+    """Solves the SIRD model at the times t_eval. Each regime of the death
+    rate (below and above the capacity K) is integrated separately, stopping
+    at the capacity crossing. Solutions are cached on the parameters rounded
+    to `decimals` places and are returned read-only."""
+    args = (round(float(x),decimals) for x in (I0,beta,gamma,delta1,delta2,K,severe))
+    return _SIRD(tuple(np.asarray(t_eval,dtype=float)),*args)
+
+def _ensemble_rhs(y,out,beta,gamma,delta1,delta2,K,severe):
+    """SIRD right-hand side for a batch of states y of shape (4,N), written
+    into out. The regime switch at the capacity K is a mask, not a branch."""
+    S,I = y[0],y[1]
+    over = severe*I > K
+    frac = np.where(over,(delta1*K+delta2*(I-K))/np.where(over,I,1),delta1)
+    np.multiply(beta*S,I,out=out[0])
+    np.multiply(gamma,I,out=out[3])
+    np.subtract(out[0],out[3],out=out[1])
+    np.negative(out[0],out=out[0])
+    np.multiply(1-frac,out[3],out=out[2])
+    np.multiply(frac,out[3],out=out[3])
+    return out
+
+def SIRD_ensemble(t_eval,I0,beta,gamma,delta1,delta2,K,severe,substeps=4):
+    """Integrates the SIRD model for a whole batch of parameter sets at once
+    with the classical fixed-step Runge-Kutta method.
+
+    The parameters are scalars or arrays broadcast to a common shape (N,), and
+    all N systems are advanced together as one (4,N) state, taking substeps
+    equal steps between consecutive times of t_eval.
+
+    Returns
+    -------
+    y : ndarray
+        Array of shape (N,4,len(t_eval)) where y[i] is the solution for the
+        ith parameter set, as returned by SIRD
+    """
+    t_eval = np.asarray(t_eval,dtype=float)
+    I0,beta,gamma,delta1,delta2,K,severe = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(x,dtype=float)) for x in (I0,beta,gamma,delta1,delta2,K,severe)])
+    params = (beta,gamma,delta1,delta2,K,severe)
+    N = len(I0)
+
+    Y = np.empty((len(t_eval),4,N))
+    y = np.array([1-I0,I0,np.zeros(N),np.zeros(N)])
+    k1,k2,k3,k4,tmp = (np.empty_like(y) for _ in range(5))
+    Y[0] = y
+    for j,dt in enumerate(np.diff(t_eval)):
+        h = dt/substeps
+        for _ in range(substeps):
+            _ensemble_rhs(y,k1,*params)
+            _ensemble_rhs(np.add(y,h/2*k1,out=tmp),k2,*params)
+            _ensemble_rhs(np.add(y,h/2*k2,out=tmp),k3,*params)
+            _ensemble_rhs(np.add(y,h*k3,out=tmp),k4,*params)
+            y += h/6*(k1+2*(k2+k3)+k4)
+        Y[j+1] = y
+    return Y.transpose(2,1,0)
+
+def plot(I0,beta,gamma,delta1,delta2,K,severe):
+    import matplotlib.pyplot as plt
     t_eval = np.arange(365)
-    y = SIRD(t_eval,I0,beta,gamma,delta1,delta2,K)
+    y = SIRD(t_eval,I0,beta,gamma,delta1,delta2,K,severe)
     fig = plt.figure()
     labels = ['Susceptible','Infected','Recovered','Died']
     for i in range(4):
@@ -0,0 +1 @@
+"""Helpers shared by the animation projects in this repository"""
@@ -0,0 +1,221 @@
+import os
+import sys
+import pickle
+import types
+import hashlib
+import numbers
+import functools
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def digest(*parts):
+    """Computes a stable hex digest of arrays, numbers, strings and (nested)
+    tuples or lists of them, for use as a cache key"""
+    h = hashlib.sha256()
+    def update(x):
+        if isinstance(x,np.ndarray):
+            x = np.ascontiguousarray(x)
+            h.update(f"array{x.dtype.str}{x.shape}".encode())
+            h.update(x.tobytes())
+        elif isinstance(x,(tuple,list)):
+            h.update(f"seq{len(x)}".encode())
+            for y in x: update(y)
+        elif isinstance(x,bytes):
+            h.update(b"bytes"+x)
+        else:
+            h.update(f"{type(x).__name__}{x!r}".encode())
+    for part in parts: update(part)
+    return h.hexdigest()
+
+def function_key(f):
+    """Computes a digest identifying the callable f by its code and the values
+    it closes over, reads from its module globals or takes as defaults.
+
+    Arrays, numbers, strings, bytes, None, modules and (nested) tuples or
+    lists of them are identified by value, and callables by their own key,
+    recursively. Any other value, e.g. a sparse matrix or an instance of a
+    user class, cannot be identified and raises a TypeError: such a callable
+    must define its own `cache_key` attribute (any value accepted by digest)
+    to be cached.
+
+    Examples
+    --------
+    >>> A = lambda t: M1+t*M2            # keyed on the arrays M1 and M2
+    >>> B = lambda t: S.toarray()+t*M2   # S is a sparse matrix
+    >>> B.cache_key = ('B',S.data,S.indices,S.indptr,M2)
+    """
+    return _function_key(f,set())
+
+def _function_key(f,seen):
+    key = getattr(f,'cache_key',None)
+    if key is not None:
+        return digest(key)
+    if isinstance(f,functools.partial):
+        return digest('partial',_function_key(f.func,seen),_value(f.args,seen),
+                      _value(sorted(f.keywords.items()),seen))
+    if isinstance(f,types.MethodType):
+        return digest('method',_value(f.__self__,seen),_function_key(f.__func__,seen))
+    code = getattr(f,'__code__',None)
+    if code is None:
+        # classes, builtins, ufuncs and other named module-level callables of
+        # libraries are identified by name
+        if _named(f):
+            return digest(type(f).__name__,f.__module__,getattr(f,'__qualname__',f.__name__))
+        raise TypeError(f"cannot compute a cache key for {f!r}; give it a `cache_key` attribute")
+    if id(f) in seen:
+        # recursive reference to a function already being keyed
+        return digest('recursive',f.__qualname__)
+    seen = seen|{id(f)}
+    cells = [c.cell_contents for c in (f.__closure__ or ())]
+    names = [n for n in _code_names(code) if n in f.__globals__]
+    return digest(f.__module__ or '',f.__qualname__,_code_key(code),
+                  _value(cells,seen),tuple(names),_value([f.__globals__[n] for n in names],seen),
+                  _value(f.__defaults__ or (),seen),_value(sorted((f.__kwdefaults__ or {}).items()),seen))
+
+def _named(f):
+    # whether f is the object its module and qualified name refer to
+    module = sys.modules.get(getattr(f,'__module__',None) or '')
+    name = getattr(f,'__qualname__',getattr(f,'__name__',None))
+    if module is None or not isinstance(name,str):
+        return False
+    x = module
+    for part in name.split('.'):
+        x = getattr(x,part,None)
+    return x is f
+
+def _code_key(code):
+    # digest of the bytecode, names and constants of code and of the code
+    # objects nested in it (lambdas, comprehensions), which repr only by address
+    consts = [_code_key(c) if isinstance(c,types.CodeType) else repr(c) for c in code.co_consts]
+    return digest(code.co_code,code.co_names,consts)
+
+def _code_names(code):
+    names = list(code.co_names)
+    for c in code.co_consts:
+        if isinstance(c,types.CodeType):
+            names += _code_names(c)
+    return dict.fromkeys(names)
+
+def _value(x,seen):
+    if x is None or isinstance(x,(np.ndarray,np.generic,numbers.Number,str,bytes)):
+        return x
+    if isinstance(x,(tuple,list)):
+        return [_value(y,seen) for y in x]
+    if isinstance(x,types.ModuleType):
+        return ('module',x.__name__)
+    if callable(x):
+        return ('callable',_function_key(x,seen))
+    raise TypeError(f"cannot compute a cache key for a value of type {type(x).__name__}; "
+                    "give the function a `cache_key` attribute")
+
+class Cache:
+    """Two-level cache of computed results: an in-memory LRU layer backed by an
+    optional on-disk layer that evicts its least recently used entries once
+    it grows beyond max_bytes.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Number of entries kept in memory
+    directory : str, optional
+        Directory of the on-disk layer. Only the memory layer is used if None
+    max_bytes : int, optional
+        Size limit of the on-disk layer
+    """
+    def __init__(self,maxsize=128,directory=None,max_bytes=2**30):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory,exist_ok=True)
+
+    def __getstate__(self):
+        # only the disk layer is shared with worker processes
+        state = self.__dict__.copy()
+        state['_memory'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self,key):
+        return os.path.join(self.directory,key+'.pkl')
+
+    def get(self,key,default=None):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.directory is None:
+            return default
+        try:
+            with open(self._path(key),'rb') as f:
+                value = pickle.load(f)
+        except (OSError,EOFError,pickle.UnpicklingError):
+            return default
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        self._remember(key,value)
+        return value
+
+    def set(self,key,value):
+        self._remember(key,value)
+        if self.directory is None:
+            return
+        tmp = self._path(key)+f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp,'wb') as f:
+            pickle.dump(value,f,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp,self._path(key))
+        self._evict()
+
+    def _remember(self,key,value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.maxsize:
+                self._memory.popitem(last=False)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # removed by a concurrent writer
+                    continue
+                entries.append((stat.st_mtime,stat.st_size,entry.path))
+        total = sum(size for _,size,_ in entries)
+        for _,size,path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Empties both layers"""
+        with self._lock:
+            self._memory.clear()
+        if self.directory is not None:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.pkl'):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+    def __contains__(self,key):
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self.directory is not None and os.path.exists(self._path(key))
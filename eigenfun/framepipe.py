@@ -0,0 +1,82 @@
+import subprocess
+import numpy as np
+
+class FramePipe:
+    """Encodes a video by writing raw frames straight into the stdin of an
+    ffmpeg process, bypassing matplotlib's animation writers.
+
+    Parameters
+    ----------
+    outfile : str
+        The output file name
+    width, height : int
+        Frame size in pixels
+    fps : float, optional
+        Frames per second
+    pix_fmt : str, optional
+        Layout of the frames passed to write, 'rgb24' for (height,width,3)
+        or 'rgba' for (height,width,4) uint8 arrays
+    codec : str, optional
+        Video codec passed to ffmpeg
+    qp : int, optional
+        Constant quantizer of libx264, overriding bitrate. At 0 the yuv420p
+        frames are encoded without loss (the chroma is still subsampled), as
+        needed for segments joined by eigenfun.segments.render_parallel, at
+        the cost of much larger files that many players cannot decode. The
+        codec's rate control is used if None
+    bitrate : int, optional
+        Video bitrate in kbps. The codec default is used if None
+    ffmpeg : str, optional
+        Path of the ffmpeg executable
+    """
+    def __init__(self,outfile,width,height,fps=30,pix_fmt='rgb24',codec='libx264',
+            qp=None,bitrate=None,ffmpeg='ffmpeg'):
+        self.outfile = outfile
+        self.shape = (height,width,4 if pix_fmt == 'rgba' else 3)
+        cmd = [ffmpeg,'-y','-loglevel','error',
+               '-f','rawvideo','-pix_fmt',pix_fmt,'-s',f'{width}x{height}',
+               '-r',str(fps),'-i','-',
+               # yuv420p needs even dimensions
+               '-vf','pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        cmd += encoder_args(codec,qp,bitrate)
+        self._proc = subprocess.Popen(cmd+[outfile],stdin=subprocess.PIPE)
+
+    def write(self,frame):
+        """Writes one frame, an array or buffer laid out as pix_fmt"""
+        frame = np.asarray(frame)
+        if frame.shape != self.shape or frame.dtype != np.uint8:
+            raise ValueError(f"Frame must be a uint8 array of shape {self.shape}")
+        self._proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def write_canvas(self,canvas):
+        """Writes the current contents of an Agg canvas (pix_fmt must be 'rgba')"""
+        self.write(canvas.buffer_rgba())
+
+    def close(self):
+        self._proc.stdin.close()
+        if self._proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {self.outfile}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+def encoder_args(codec='libx264',qp=None,bitrate=None):
+    """The ffmpeg output options of FramePipe and ffmpeg_writer (see FramePipe
+    for the parameters)"""
+    args = ['-vcodec',codec,'-pix_fmt','yuv420p']
+    if qp is not None:
+        args += ['-qp',str(qp)]
+    elif bitrate is not None:
+        args += ['-b:v',f'{bitrate}k']
+    return args
+
+def ffmpeg_writer(fps,qp=None,bitrate=None,**kwargs):
+    """A matplotlib FFMpegWriter encoding with libx264 like FramePipe (see
+    FramePipe for qp and bitrate). Keyword arguments are passed on to
+    FFMpegWriter."""
+    from matplotlib.animation import FFMpegWriter
+    return FFMpegWriter(fps=fps,codec='libx264',extra_args=encoder_args('libx264',qp,bitrate)[2:],
+                        **kwargs)
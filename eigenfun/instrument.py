@@ -0,0 +1,151 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+class Stage:
+    """Progress and timing of one stage of a computation (e.g. 'solve',
+    'match', 'contour', 'draw' or 'encode'), reported to the sinks of an
+    Instrument as 'start', 'progress' and 'end' events.
+
+    An event is a dict with the keys event, stage, label, count (items done),
+    total, seconds (wall time since the start), busy (time spent inside
+    timed blocks, None if there were none) and rate (items per second of busy
+    time, or of wall time if there is none), plus the instrument's context.
+    """
+    def __init__(self,instrument,name,total=None,label=None):
+        self.instrument = instrument
+        self.name = name
+        self.total = total
+        self.label = label
+        self.count = 0
+        self.busy = None
+        self.done = False
+        self.start = time.perf_counter()
+        self.seconds = 0.
+        instrument.emit(self,'start')
+
+    def advance(self,k=1):
+        """Marks k more items done"""
+        self.count += k
+        self.instrument.emit(self,'progress')
+
+    def goto(self,count):
+        """Sets the number of items done"""
+        self.count = count
+        self.instrument.emit(self,'progress')
+
+    @contextmanager
+    def timed(self):
+        """Adds the time spent in the block to the busy time of the stage, for
+        stages interleaved with others"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy = (self.busy or 0.)+time.perf_counter()-start
+
+    def finish(self,count=None):
+        """Ends the stage, optionally overriding the number of items done"""
+        if self.done:
+            return
+        if count is not None:
+            self.count = count
+        self.done = True
+        self.instrument.emit(self,'end')
+
+    def event(self,kind):
+        self.seconds = time.perf_counter()-self.start
+        seconds = self.seconds if self.busy is None else self.busy
+        return {'event':kind,'stage':self.name,'label':self.label,'count':self.count,
+                'total':self.total,'seconds':self.seconds,'busy':self.busy,
+                'rate':self.count/seconds if seconds > 0 else None}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.finish()
+
+class _NullStage:
+    """Stage that records nothing, used when instrumentation is disabled"""
+    def advance(self,k=1): pass
+    def goto(self,count): pass
+    def timed(self): return nullcontext()
+    def finish(self,count=None): pass
+    def __enter__(self): return self
+    def __exit__(self,*exc): pass
+
+class Instrument:
+    """Sends the events of the stages it starts to sinks, callables taking
+    one event dict (see Stage). Keyword arguments are added to every event,
+    e.g. to tag the events of one job.
+
+    Examples
+    --------
+    >>> log = Instrument(ConsoleSink(),JSONSink('stages.jsonl'),job='lena')
+    >>> eig_trajectories(A,T,verbose=log)
+    """
+    def __init__(self,*sinks,**context):
+        self.sinks = sinks
+        self.context = context
+
+    def stage(self,name,total=None,label=None):
+        """Starts a stage of `total` items. label is the title of its console
+        progress bar; stages without one are timed but not displayed"""
+        return Stage(self,name,total,label)
+
+    def emit(self,stage,kind):
+        event = stage.event(kind)
+        event.update(self.context)
+        for sink in self.sinks:
+            sink(event)
+
+class _NullInstrument:
+    def stage(self,name,total=None,label=None):
+        return _NullStage()
+
+NULL = _NullInstrument()
+
+class ConsoleSink:
+    """Displays a progress bar in the console for every labeled stage"""
+    def __init__(self):
+        self._bars = {}
+
+    def __call__(self,event):
+        if event['label'] is None:
+            return
+        stage = event['stage']
+        if event['event'] == 'start':
+            from progress.bar import IncrementalBar
+            self._bars[stage] = IncrementalBar(event['label'],max=event['total'] or 1,
+                                               suffix='%(percent)d%%')
+        elif stage in self._bars:
+            bar = self._bars[stage]
+            if event['event'] == 'end':
+                bar.goto(bar.max)
+                bar.finish()
+                del self._bars[stage]
+            else:
+                bar.goto(min(event['count'],bar.max))
+
+class JSONSink:
+    """Appends the 'end' event of every stage to a file as a line of JSON"""
+    def __init__(self,filename):
+        self.filename = filename
+
+    def __call__(self,event):
+        if event['event'] == 'end':
+            with open(self.filename,'a') as f:
+                f.write(json.dumps(event)+'\n')
+
+def instrument(verbose):
+    """The Instrument for a `verbose` argument: an Instrument is used as is, a
+    callable is called with every event, True shows console progress bars
+    and False disables instrumentation"""
+    if isinstance(verbose,(Instrument,_NullInstrument)):
+        return verbose
+    if callable(verbose):
+        return Instrument(verbose)
+    if verbose:
+        return Instrument(ConsoleSink())
+    return NULL
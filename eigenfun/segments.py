@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+def frame_chunks(nframes,chunks):
+    """Splits the frames [0,nframes) into at most `chunks` contiguous ranges of
+    nearly equal length"""
+    bounds = np.linspace(0,nframes,min(chunks,nframes)+1).astype(int)
+    return [range(a,b) for a,b in zip(bounds[:-1],bounds[1:])]
+
+def concat_segments(segments,outfile,ffmpeg='ffmpeg'):
+    """Joins video segments encoded with identical settings into outfile
+    without re-encoding"""
+    fd,listfile = tempfile.mkstemp(suffix='.txt',dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        with os.fdopen(fd,'w') as f:
+            for segment in segments:
+                f.write(f"file '{os.path.abspath(segment)}'\n")
+        subprocess.run([ffmpeg,'-y','-loglevel','error','-f','concat','-safe','0',
+                        '-i',listfile,'-c','copy',outfile],check=True)
+    finally:
+        os.remove(listfile)
+
+def render_parallel(render,nframes,outfile,workers,ffmpeg='ffmpeg',encode=None):
+    """Renders an animation in parallel. The frames are split into contiguous
+    chunks, each worker process renders and encodes one chunk losslessly as a
+    segment, and the segments are joined. Independently encoded lossy
+    segments would decode to other frames than a serial render, so the joined
+    video is then encoded once more with the serial settings `encode`.
+
+    Parameters
+    ----------
+    render : callable
+        Picklable function render(frames=...,outfile=...,lossless=True) that
+        renders the frames in the range `frames` and saves them as the video
+        outfile, encoded without loss
+    nframes : int
+        Total number of frames
+    outfile : str
+        The output file name
+    workers : int
+        Number of worker processes
+    encode : list of str, optional
+        ffmpeg output options of the serial render (see
+        eigenfun.framepipe.encoder_args). The lossless join is kept as is if
+        None
+    """
+    ext = os.path.splitext(outfile)[1]
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outfile)))
+    try:
+        chunks = frame_chunks(nframes,workers)
+        segments = [os.path.join(tmpdir,f'segment{k:04d}{ext}') for k in range(len(chunks))]
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(render,frames=chunk,outfile=segment,lossless=True)
+                       for chunk,segment in zip(chunks,segments)]
+            for future in futures:
+                future.result()
+        if encode is None:
+            concat_segments(segments,outfile,ffmpeg)
+        else:
+            joined = os.path.join(tmpdir,f'joined{ext}')
+            concat_segments(segments,joined,ffmpeg)
+            subprocess.run([ffmpeg,'-y','-loglevel','error','-i',joined]+list(encode)+[outfile],
+                           check=True)
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors=True)
@@ -1,24 +1,120 @@
+import os
+import sys
+from functools import partial
 import numpy as np
 import scipy.linalg as la
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from mpl_toolkits.mplot3d import Axes3D
-from progress.bar import IncrementalBar
 import eigentools as et
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from eigenfun.instrument import instrument
+from eigenfun.framepipe import FramePipe, encoder_args, ffmpeg_writer
+from eigenfun.segments import render_parallel
 
-def animate_eig(A,T,outfile,verbose=False):
-    """Animates the eigenvalues of the matrix function A(t). Saves the animation
-    as "outfile".
+def _pipe_axes(x0,x1,y0,y1):
+    """Sets up a headless Agg figure like the ones used by the animations"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=(6,6),dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    fig.subplots_adjust(left=0,right=1,bottom=0,top=1)
+    ax.grid(False)
+    ax.set_facecolor('black')
+    ax.set_xlim((x0,x1))
+    ax.set_ylim((y0,y1))
+    return canvas,ax
+
+def _pipe_eig(E,outfile,fps,frames=None,verbose=False,qp=None):
+    """Renders the animation of animate_eig through a FramePipe. The trails only
+    grow, so each frame draws just its new segments onto the saved background
+    and then the moving points on top."""
+    from matplotlib.collections import LineCollection
+    n,m = E.shape
+    frames = range(m) if frames is None else frames
+    canvas,ax = _pipe_axes(E.real.min()-1,E.real.max()+1,E.imag.min()-1,E.imag.max()+1)
+    colors = [f'C{k}' for k in range(n)] if n <= 10 else ['C0']
+    trails = ax.add_collection(LineCollection([],colors=colors,animated=True))
+    points = ax.scatter(E[:,0].real,E[:,0].imag,c=colors if n <= 10 else 'C0',s=36,
+                        animated=True)
+    canvas.draw()
+    xy = np.stack((E.real,E.imag),axis=-1)
+    # trails drawn before the first frame of this range, segment by segment so
+    # that the pixels match a render of all frames
+    for i in range(1,frames.start+1):
+        trails.set_segments(xy[:,i-1:i+1])
+        ax.draw_artist(trails)
+    background = canvas.copy_from_bbox(ax.bbox)
+
+    width,height = canvas.get_width_height(physical=True)
+    log = instrument(verbose)
+    draw = log.stage('draw',len(frames),"Rendering\t")
+    encode = log.stage('encode',len(frames))
+    with FramePipe(outfile,width,height,fps=fps,pix_fmt='rgba',qp=qp) as pipe:
+        for i in frames:
+            with draw.timed():
+                canvas.restore_region(background)
+                if i > frames.start:
+                    trails.set_segments(xy[:,i-1:i+1])
+                    ax.draw_artist(trails)
+                    background = canvas.copy_from_bbox(ax.bbox)
+                points.set_offsets(xy[:,i])
+                ax.draw_artist(points)
+            with encode.timed():
+                pipe.write_canvas(canvas)
+            draw.advance()
+            encode.advance()
+    draw.finish()
+    encode.finish()
+
+def _pipe_eig_loops(L,outfile,fps,limits,verbose=False,qp=None):
+    """Renders the animation of animate_eig_loops through a FramePipe, drawing
+    all loops of a frame as a single LineCollection over a cached background"""
+    from matplotlib.collections import LineCollection
+    l = L.shape[2]
+    canvas,ax = _pipe_axes(*limits)
+    loops = ax.add_collection(LineCollection([],colors='C5',animated=True))
+    canvas.draw()
+    background = canvas.copy_from_bbox(ax.bbox)
+
+    width,height = canvas.get_width_height(physical=True)
+    log = instrument(verbose)
+    draw = log.stage('draw',l,"Rendering\t")
+    encode = log.stage('encode',l)
+    with FramePipe(outfile,width,height,fps=fps,pix_fmt='rgba',qp=qp) as pipe:
+        for i in range(l):
+            with draw.timed():
+                canvas.restore_region(background)
+                loops.set_segments(np.stack((L[:,:,i].real,L[:,:,i].imag),axis=-1))
+                ax.draw_artist(loops)
+            with encode.timed():
+                pipe.write_canvas(canvas)
+            draw.advance()
+            encode.advance()
+    draw.finish()
+    encode.finish()
+
+def render_eig(E,outfile,frames=None,backend='matplotlib',verbose=False,lossless=False):
+    """Renders the animation of the eigenvalue trajectories E (see animate_eig)
 
     Parameters
     ----------
-    A : callable
-        Matrix-valued function of one parameter t
-    T : 1d array
-        Values of the parameter t
+    E : ndarray
+        Array of eigenvalue trajectories (see eigentools.eig_trajectories)
+    outfile : str
+        The output file name
+    frames : range, optional
+        The frames to render. All of them by default
+    backend : str, optional
+        'matplotlib' or 'pipe' (see animate_eig)
+    lossless : bool, optional
+        If True, encodes without loss (see animate_eig)
     """
-    n = A(T[0]).shape[0]
-    E = et.eig_trajectories(A,T,verbose=verbose)
+    n,m = E.shape
+    frames = range(m) if frames is None else frames
+    qp = 0 if lossless else None
+    if backend == 'pipe':
+        return _pipe_eig(E,outfile,1000/15,frames,verbose,qp)
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
 
     #set up figure
     fig = plt.figure(figsize=(6,6),dpi=100)
@@ -42,17 +138,57 @@ def animate_eig(A,T,outfile,verbose=False):
     #function to update line objects
     def update(i):
         for j in range(n):
-            points[j].set_data(E[j,i].real,E[j,i].imag)
+            points[j].set_data(E[j,i:i+1].real,E[j,i:i+1].imag)
             trajectories[j].set_data(E[j,:i+1].real,E[j,:i+1].imag)
-        if verbose: bar.next()
 
     #animation
-    if verbose: bar = IncrementalBar("Rendering\t",max=len(T),suffix='%(percent)d%%')
-    ani = animation.FuncAnimation(fig,update,frames=len(T),interval=15)
-    ani.save(outfile)
-    if verbose: bar.next(), bar.finish()
+    with instrument(verbose).stage('draw',len(frames),"Rendering\t") as stage:
+        ani = animation.FuncAnimation(fig,update,frames=frames,interval=15)
+        ani.save(outfile,writer=ffmpeg_writer(1000/15,qp),progress_callback=lambda i,n: stage.advance())
+    plt.close(fig)
 
-def animate_eig_loops(A,U,V,outfile,verbose=False):
+def animate_eig(A,T,outfile,verbose=False,batched=False,matching='greedy',cache=None,
+        backend='matplotlib',render_workers=None,lossless=False):
+    """Animates the eigenvalues of the matrix function A(t). Saves the animation
+    as "outfile".
+
+    Parameters
+    ----------
+    A : callable
+        Matrix-valued function of one parameter t
+    T : 1d array
+        Values of the parameter t
+    batched : bool, optional
+        If True, A is evaluated on the whole array T at once (see
+        eigentools.eig_stack)
+    matching : str or callable, optional
+        Strategy for matching eigenvalues (see eigentools.match_eigenvalues)
+    cache : eigenfun.cache.Cache, optional
+        Cache of computed trajectories (see eigentools.eig_trajectories)
+    backend : str, optional
+        'matplotlib' saves through FuncAnimation, 'pipe' blits the changing
+        artists onto a static background and streams raw frames to ffmpeg
+    render_workers : int, optional
+        If greater than 1, the frames are rendered in this many processes as
+        separate lossless segments, which are then joined and encoded once
+        into the same video as a serial render (see
+        eigenfun.segments.render_parallel)
+    lossless : bool, optional
+        If True, the yuv420p frames are encoded without loss (libx264 at
+        quantizer 0), which gives much larger files that many players cannot
+        decode. The joined segments are then kept as they are
+    """
+    E = et.eig_trajectories(A,T,verbose=verbose,batched=batched,matching=matching,
+                            cache=cache)
+    if render_workers is not None and render_workers > 1:
+        render = partial(render_eig,E,backend=backend)
+        render_parallel(render,E.shape[1],outfile,render_workers,
+                        encode=None if lossless else encoder_args())
+    else:
+        render_eig(E,outfile,backend=backend,verbose=verbose,lossless=lossless)
+
+def animate_eig_loops(A,U,V,outfile,verbose=False,batched=False,matching='greedy',
+        workers=None,store=None,cache=None,backend='matplotlib',lossless=False):
     """Animates the loops of eigenvalues for the matrix function A(u,v). Saves
     the animation as "outfile".
 
@@ -64,9 +200,39 @@ def animate_eig_loops(A,U,V,outfile,verbose=False):
         Values of the parameter u
     V : 1d array
         Values of the parameter v
+    batched : bool, optional
+        If True, A(U,v) is evaluated on the whole array U at once for each v
+    matching : str or callable, optional
+        Strategy for matching eigenvalues (see eigentools.match_eigenvalues)
+    workers : int, optional
+        Number of threads used to compute the loops (see eigentools.eig_loops)
+    store : str, optional
+        .npy file the loops are streamed to (see eigentools.eig_loops). Any
+        slices already in the store are not recomputed, and the loops are read
+        from it lazily while rendering
+    cache : eigenfun.cache.Cache, optional
+        Cache of computed trajectories (see eigentools.eig_loops)
+    backend : str, optional
+        'matplotlib' saves through FuncAnimation, 'pipe' streams raw frames to
+        ffmpeg, drawing each frame's loops as one LineCollection
+    lossless : bool, optional
+        If True, encodes without loss (see animate_eig)
     """
-    n = A(U[0],V[0]).shape[0]
-    L = et.eig_loops(A,U,V,verbose=verbose)
+    L = et.eig_loops(A,U,V,verbose=verbose,batched=batched,matching=matching,
+                     workers=workers,outfile=store,cache=cache)
+    if store is not None: L = et.load_eig_loops(store)
+    n = L.shape[0]
+
+    # limits are reduced one slice at a time so a memory-mapped L is never
+    # loaded in full
+    x0 = min(L[:,:,k].real.min() for k in range(L.shape[2]))-1
+    x1 = max(L[:,:,k].real.max() for k in range(L.shape[2]))+1
+    y0 = min(L[:,:,k].imag.min() for k in range(L.shape[2]))-1
+    y1 = max(L[:,:,k].imag.max() for k in range(L.shape[2]))+1
+    if backend == 'pipe':
+        return _pipe_eig_loops(L,outfile,1000/50,(x0,x1,y0,y1),verbose,0 if lossless else None)
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
 
     #set up figure
     # plt.ioff()
@@ -76,8 +242,6 @@ def animate_eig_loops(A,U,V,outfile,verbose=False):
     ax.grid(False)
     # ax.set_aspect('equal')
     ax.set_facecolor('black')
-    x0,x1 = L.real.min()-1,L.real.max()+1
-    y0,y1 = L.imag.min()-1,L.imag.max()+1
     plt.xlim((x0,x1))
     plt.ylim((y0,y1))
 
@@ -88,11 +252,10 @@ def animate_eig_loops(A,U,V,outfile,verbose=False):
     def update(i):
         for j in range(n):
             trajectories[j].set_data(L[j,:,i].real,L[j,:,i].imag)
-        if verbose: bar.next()
 
     #animation
-    if verbose: bar = IncrementalBar("Rendering\t",max=len(V),suffix='%(percent)d%%')
-    ani = animation.FuncAnimation(fig,update,frames=len(V),interval=50)
-    ani.save(outfile)
-    if verbose: bar.next(); bar.finish()
+    with instrument(verbose).stage('draw',len(V),"Rendering\t") as stage:
+        ani = animation.FuncAnimation(fig,update,frames=len(V),interval=50)
+        ani.save(outfile,writer=ffmpeg_writer(1000/50,0 if lossless else None),
+                 progress_callback=lambda i,n: stage.advance())
     # plt.ion()
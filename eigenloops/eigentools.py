@@ -1,8 +1,140 @@
+import os
+import sys
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 import numpy as np
 import scipy.linalg as la
-from progress.bar import IncrementalBar
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.linalg import eigs
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from eigenfun.cache import Cache, digest, function_key
+from eigenfun.instrument import instrument
 
-def eig_trajectories(A,T,verbose=False):
+def greedy_assignment(D):
+    """Vectorized greedy assignment on a square cost matrix. In each round every
+    unassigned row claims its nearest unassigned column, and each claimed column
+    goes to the closest of the rows claiming it.
+
+    Parameters
+    ----------
+    D : 2d array
+        Square cost matrix
+
+    Returns
+    -------
+    perm : 1d array
+        perm[j] is the column assigned to row j
+    """
+    n = D.shape[0]
+    perm = np.empty(n,dtype=int)
+    rows,cols = np.arange(n),np.arange(n)
+    while rows.size:
+        sub = D[np.ix_(rows,cols)]
+        best = np.argmin(sub,axis=1)
+        order = np.lexsort((sub[np.arange(rows.size),best],best))
+        first = np.ones(order.size,dtype=bool)
+        first[1:] = best[order[1:]]!=best[order[:-1]]
+        win = order[first]
+        perm[rows[win]] = cols[best[win]]
+        rows = np.delete(rows,win)
+        cols = np.delete(cols,best[win])
+    return perm
+
+def optimal_assignment(D):
+    """Globally optimal (minimum total cost) assignment on a square cost matrix.
+    See greedy_assignment."""
+    return linear_sum_assignment(D)[1]
+
+MATCHERS = {'greedy':greedy_assignment,'optimal':optimal_assignment}
+
+def match_eigenvalues(w0,w1,matching='greedy'):
+    """Matches the eigenvalues w1 to the eigenvalues w0, so that w1[perm] is the
+    continuation of w0
+
+    Parameters
+    ----------
+    w0 : 1d array
+        Previous eigenvalues
+    w1 : 1d array
+        New eigenvalues
+    matching : str or callable, optional
+        'greedy', 'optimal', or a function taking the distance matrix
+        D[j,k] = |w0[j]-w1[k]| and returning the assignment perm
+
+    Returns
+    -------
+    perm : 1d array
+        Permutation such that w1[perm[j]] continues w0[j]
+    """
+    D = np.abs(w0[:,np.newaxis]-w1[np.newaxis,:])
+    if callable(matching):
+        return np.asarray(matching(D))
+    if matching not in MATCHERS:
+        raise ValueError(f"Unknown matching '{matching}'")
+    # if every eigenvalue's nearest neighbor is distinct, that is both the greedy
+    # and the optimal assignment
+    perm = np.argmin(D,axis=1)
+    if np.all(np.bincount(perm,minlength=len(w1))==1):
+        return perm
+    return MATCHERS[matching](D)
+
+def eig_stack(A,T,batched=False,verbose=False):
+    """Computes the eigenvalues of A(t) for every value of the parameter t,
+    without any ordering between consecutive parameter values
+
+    Parameters
+    ----------
+    A : callable
+        Matrix-valued function of one parameter t. If batched is True, A must
+        accept the whole array T and return an (m,n,n) stack of matrices
+    T : 1d array
+        Values of the parameter t
+    batched : bool, optional
+        If True, evaluates A once on all of T and computes the eigenvalues of
+        the whole stack in a single call
+    verbose : bool, Instrument or callable, optional
+        Progress and timing reporting of the 'solve' stage (see
+        eig_trajectories)
+
+    Returns
+    -------
+    W : ndarray
+        Array of shape (m,n) where W[k] holds the eigenvalues of A(T[k])
+    """
+    with instrument(verbose).stage('solve',len(T),"Calculating\t") as stage:
+        if batched:
+            M = np.asarray(A(np.asarray(T)))
+            if M.ndim != 3 or M.shape[0] != len(T):
+                raise ValueError("Batched matrix function must return an (m,n,n) array")
+            if M.shape[1]!=M.shape[2]:
+                raise ValueError("Matrix must be square")
+            W = np.linalg.eigvals(M).astype("complex")
+            stage.finish(len(T))
+            return W
+
+        M = A(T[0])
+        n,m = M.shape
+        if n!=m:
+            raise ValueError("Matrix must be square")
+        W = np.empty((len(T),n),dtype="complex")
+        W[0] = la.eig(M,right=False)
+        stage.advance()
+        for i,t in enumerate(T[1:]):
+            W[i+1] = la.eig(A(t),right=False)
+            stage.advance()
+    return W
+
+def _cache_key(name,A,*args):
+    args = [function_key(a) if callable(a) else a for a in args]
+    return digest(name,function_key(A),*args)
+
+def eig_trajectories(A,T,verbose=False,batched=False,matching='greedy',cache=None):
     """Computes the trajectories of the eigenvalues of the
     matrix function A(t)
 
@@ -12,33 +144,282 @@ def eig_trajectories(A,T,verbose=False):
         Matrix-valued function of one parameter t
     T : 1d array
         Values of the parameter t
+    verbose : bool, Instrument or callable, optional
+        If True, displays a progress bar in the console. An
+        eigenfun.instrument.Instrument or a callable receives the timing and
+        progress events of the solve and match stages instead
+    batched : bool, optional
+        If True, A is evaluated on the whole array T at once and must return
+        an (m,n,n) stack of matrices (see eig_stack)
+    matching : str or callable, optional
+        Strategy for matching eigenvalues between consecutive parameter values
+        (see match_eigenvalues)
+    cache : eigenfun.cache.Cache, optional
+        If given, the trajectories are looked up in and stored to this cache,
+        keyed on A (see eigenfun.cache.function_key), T and the options. A
+        TypeError is raised if A closes over values the key cannot identify
+        and has no cache_key attribute
+
+    Returns
+    -------
+    E : ndarray
+        Array of eigenvalue trajectories where E[i] is the
+        trajectory of the ith eigenvalue as a 1d array
+    """
+    if cache is not None:
+        key = _cache_key('eig_trajectories',A,np.asarray(T),batched,matching)
+        E = cache.get(key)
+        if E is not None:
+            return E.copy()
+        E = eig_trajectories(A,T,verbose,batched,matching)
+        cache.set(key,E)
+        return E.copy()
+
+    log = instrument(verbose)
+    W = eig_stack(A,T,batched,log)
+    m,n = W.shape
+    E = np.empty((n,m),dtype="complex")
+    E[:,0] = W[0]
+    with log.stage('match',m-1,"Matching\t") as stage:
+        for i,w in enumerate(W[1:]):
+            E[:,i+1] = w[match_eigenvalues(E[:,i],w,matching)]
+            stage.advance()
+    return E
+
+def adaptive_eig_trajectories(A,t0,t1,tol=1e-2,h0=None,hmin=None,hmax=None,
+        gtol=None,matching='greedy',verbose=False):
+    """Computes the trajectories of the eigenvalues of the matrix function A(t)
+    on the interval [t0,t1], choosing the parameter values adaptively. Each
+    step is matched against the linear extrapolation of the last step, so
+    eigenvalues passing through a crossing keep their trajectories. Steps are
+    shortened where the eigenvalues move quickly or stray from the prediction
+    by more than half the gap to their neighbours, and lengthened where they
+    move slowly.
+
+    Parameters
+    ----------
+    A : callable
+        Matrix-valued function of one parameter t
+    t0, t1 : float
+        End points of the parameter interval
+    tol : float, optional
+        Largest distance any eigenvalue may move in one step
+    h0 : float, optional
+        Initial step size. Defaults to (t1-t0)/100
+    hmin : float, optional
+        Smallest allowed step size. Defaults to (t1-t0)*1e-6
+    hmax : float, optional
+        Largest allowed step size. Defaults to (t1-t0)/10
+    gtol : float, optional
+        Gap below which two eigenvalues are treated as one, so that repeated
+        eigenvalues do not limit the step size. Swapping such eigenvalues
+        moves the trajectories by at most gtol. Defaults to tol*1e-3
+    matching : str or callable, optional
+        Strategy for matching eigenvalues (see match_eigenvalues)
 
     Returns
     -------
+    T : 1d array
+        Values of the parameter t chosen by the stepper
     E : ndarray
         Array of eigenvalue trajectories where E[i] is the
         trajectory of the ith eigenvalue as a 1d array
     """
-    n,m = A(T[0]).shape
+    span = t1-t0
+    h = span/100 if h0 is None else h0
+    hmin = span*1e-6 if hmin is None else hmin
+    hmax = span/10 if hmax is None else hmax
+    gtol = tol*1e-3 if gtol is None else gtol
+
+    M = A(t0)
+    n,m = M.shape
+    if n!=m:
+        raise ValueError("Matrix must be square")
+
+    def separation(w):
+        # smallest gap between distinct eigenvalues, ignoring repeated ones
+        D = np.abs(w[:,np.newaxis]-w[np.newaxis,:])
+        D[D <= gtol] = np.inf
+        return D.min() if n > 1 else np.inf
+
+    t = t0
+    e = la.eig(M,right=False)
+    T,E = [t],[e]
+    velocity = np.zeros_like(e)
+    stage = instrument(verbose).stage('solve',100,"Calculating\t")
+    solves = 1
+    while t < t1:
+        h = min(h,hmax,t1-t)
+        w = la.eig(A(t+h),right=False)
+        solves += 1
+        p = e+velocity*h
+        w = w[match_eigenvalues(p,w,matching)]
+        # the displacement is limited by the tolerance, and the error of the
+        # prediction by half the smallest gap between distinct predicted
+        # eigenvalues (beyond which matching becomes ambiguous)
+        move,d = np.abs(w-e).max(),np.abs(w-p).max()
+        ratio = min(tol/move if move > 0 else np.inf,0.5*separation(p)/d if d > 0 else np.inf)
+        if ratio < 1 and h > hmin:
+            h = max(h/2,hmin)
+            continue
+        velocity = (w-e)/h
+        t = t1 if h == t1-t else t+h
+        e = w
+        T.append(t)
+        E.append(e)
+        h = max(h*min(2,0.9*ratio),hmin)
+        stage.goto(int(100*(t-t0)/span))
+    # progress is shown in percent of the interval, the items are the solves
+    stage.finish(solves)
+    return np.array(T),np.array(E).T
+
+def sparse_eig_trajectories(A,T,k=6,sigma=None,which='LM',follow=False,tol=0,
+        matching='greedy',verbose=False):
+    """Computes the trajectories of k selected eigenvalues of the sparse matrix
+    function A(t) with ARPACK. Each step is warm-started from the eigenvectors
+    of the previous step, so few Arnoldi iterations are needed when
+    consecutive parameter values are close.
+
+    Parameters
+    ----------
+    A : callable
+        Function of one parameter t returning a square sparse matrix, dense
+        array or LinearOperator
+    T : 1d array
+        Values of the parameter t
+    k : int, optional
+        Number of eigenvalues to track
+    sigma : complex, optional
+        If given, uses shift-invert mode to find the k eigenvalues nearest
+        sigma (A(t) must then be a matrix, not a LinearOperator)
+    which : str, optional
+        Which eigenvalues to find when sigma is None, e.g. 'LM' for largest
+        modulus (see scipy.sparse.linalg.eigs)
+    follow : bool, optional
+        If True and sigma is given, moves the shift to the mean of the previous
+        step's eigenvalues so that the tracked eigenvalues are followed rather
+        than those nearest the fixed target
+    tol : float, optional
+        Relative accuracy of the eigenvalues (0 is machine precision)
+    matching : str or callable, optional
+        Strategy for matching eigenvalues (see match_eigenvalues)
+
+    Returns
+    -------
+    E : ndarray
+        Array of eigenvalue trajectories of shape (k,len(T)) where E[i] is
+        the trajectory of the ith tracked eigenvalue
+    """
+    M = A(T[0])
+    n,m = M.shape
     if n!=m:
         raise ValueError("Matrix must be square")
 
     m = len(T)
-    E = np.empty((n,m),dtype="complex")
-    E[:,0] = la.eig(A(T[0]),right=False)
-    if verbose: bar = IncrementalBar("Calculating\t", max=m,suffix='%(percent)d%%')
+    E = np.empty((k,m),dtype="complex")
+    E[:,0],v = eigs(M,k=k,sigma=sigma,which=which,tol=tol)
+    stage = instrument(verbose).stage('solve',m,"Calculating\t")
+    stage.advance()
     for i,t in enumerate(T[1:]):
-        w = la.eig(A(t),right=False)
-        mask = list(range(n))
-        for eig in w:
-            idx = np.argmin(np.abs(eig-E[:,i][mask]))
-            E[mask[idx],i+1] = eig
-            del mask[idx]
-        if verbose: bar.next()
-    if verbose: bar.next(); bar.finish()
+        M = A(t)
+        # start the Krylov space from the previous eigenvectors
+        v0 = v.sum(axis=1)
+        if np.dtype(M.dtype).kind != 'c': v0 = v0.real
+        shift = E[:,i].mean() if follow and sigma is not None else sigma
+        w,v = eigs(M,k=k,sigma=shift,which=which,v0=v0,tol=tol)
+        perm = match_eigenvalues(E[:,i],w,matching)
+        E[:,i+1] = w[perm]
+        v = v[:,perm]
+        stage.advance()
+    stage.finish()
     return E
 
-def eig_loops(A,U,V,verbose=False):
+def loop_slice(A,U,v,batched=False,matching='greedy',cache=None):
+    """Computes the eigenvalue trajectories of A(u,v) over U for a single value
+    of v. This is the independent unit of work in eig_loops."""
+    if cache is not None:
+        key = _cache_key('loop_slice',A,np.asarray(U),v,batched,matching)
+        E = cache.get(key)
+        if E is not None:
+            return E.copy()
+    B = lambda u: A(u,v)
+    E = eig_trajectories(B,U,batched=batched,matching=matching)
+    if cache is not None: cache.set(key,E)
+    return E
+
+class _SingleThreadedBLAS:
+    """Pins BLAS to one thread while any task holding it runs. The limit is
+    process-wide, so it is applied by the first of the concurrent tasks and
+    restored by the last."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._limits = None
+
+    def __enter__(self):
+        with self._lock:
+            if self._count == 0 and threadpool_limits is not None:
+                self._limits = threadpool_limits(limits=1)
+            self._count += 1
+
+    def __exit__(self,*exc):
+        with self._lock:
+            self._count -= 1
+            if self._count == 0 and self._limits is not None:
+                self._limits.restore_original_limits()
+                self._limits = None
+
+_single_threaded_blas = _SingleThreadedBLAS()
+
+def _pinned_loop_slice(*args):
+    with _single_threaded_blas:
+        return loop_slice(*args)
+
+def iter_eig_loops(A,U,V,batched=False,matching='greedy',workers=None,
+        executor=None,start=0,prev=None,cache=None):
+    """Generates the slices L[:,:,k] of eig_loops in order, as they are
+    completed (see eig_loops for the parameters)
+
+    Parameters
+    ----------
+    start : int, optional
+        Index of the first value of V to compute
+    prev : 1d array, optional
+        The eigenvalues L[:,0,start-1] of the previous slice, used to label the
+        first generated slice consistently when resuming
+
+    Yields
+    ------
+    k : int
+        Index into V
+    E : ndarray
+        The slice L[:,:,k], with rows labeled consistently with earlier slices
+    """
+    pool = None
+    task = loop_slice
+    if executor is None and workers is not None and workers > 1:
+        # BLAS is pinned only while the pool's tasks run, not while the
+        # consumer holds a generated slice
+        executor = pool = ThreadPoolExecutor(workers)
+        task = _pinned_loop_slice
+
+    # the slices are independent, only the relabeling below depends on order
+    try:
+        if executor is None:
+            slices = (loop_slice(A,U,v,batched,matching,cache) for v in V[start:])
+        else:
+            slices = executor.map(task,repeat(A),repeat(U),V[start:],
+                                  repeat(batched),repeat(matching),repeat(cache))
+        for k,E in enumerate(slices,start):
+            if prev is not None:
+                E = E[match_eigenvalues(prev,E[:,0],matching)]
+            prev = E[:,0]
+            yield k,E
+    finally:
+        if pool is not None: pool.shutdown(cancel_futures=True)
+
+def eig_loops(A,U,V,verbose=False,batched=False,matching='greedy',workers=None,
+        executor=None,outfile=None,cache=None,key=None):
     """Computes the loops of eigenvalues for the matrix function A(u,v)
 
     Parameters
@@ -49,6 +430,34 @@ def eig_loops(A,U,V,verbose=False):
         Values of the parameter u
     V : 1d array
         Values of the parameter v
+    batched : bool, optional
+        If True, A(U,v) is evaluated on the whole array U at once for each v
+        and must return an (m,n,n) stack of matrices
+    matching : str or callable, optional
+        Strategy for matching eigenvalues (see match_eigenvalues)
+    workers : int, optional
+        If greater than 1, computes the trajectories for each v on a pool of
+        this many threads, with the BLAS thread count pinned to 1 (requires
+        threadpoolctl for the pinning)
+    executor : concurrent.futures.Executor, optional
+        Executor used to compute the trajectories for each v, e.g. a
+        ProcessPoolExecutor. A must then be picklable (no lambdas)
+    outfile : str, optional
+        If given, each completed slice is written to this memory-mapped .npy
+        file instead of being held in memory. An interrupted run with the same
+        outfile resumes after the last completed slice (see load_eig_loops).
+        Resuming with a different A, U, V, batched or matching raises a
+        ValueError
+    cache : eigenfun.cache.Cache, optional
+        If given, the trajectories for each v are looked up in and stored to
+        this cache (see eig_trajectories)
+    key : optional
+        Value identifying A (and a callable matching) in the outfile, any
+        value accepted by eigenfun.cache.digest. Defaults to the key used by
+        the cache, which identifies A by its code and captured values. Pass
+        one if A captures state that changes between runs, e.g. a counter. If
+        A cannot be identified, only U, V and the options are checked, with a
+        warning
 
     Returns
     -------
@@ -56,32 +465,111 @@ def eig_loops(A,U,V,verbose=False):
         Array of eigenvalue loops where L[i] is a 2d array for the ith eigenvalue.
         L[i,j,k] = the ith eigenvalue of A(U[j],V[k])
     """
-    n,m = A(U[0],V[0]).shape
-    if n!=m:
-        raise ValueError("Matrix must be square")
-
-    m = len(U)
     l = len(V)
+    L,start,prev = None,0,None
+    if outfile is not None:
+        key = _resume_key(A,U,V,batched,matching,key)
+        if os.path.exists(_progress_file(outfile)):
+            start,stored = _read_progress(outfile,key=True)
+            if stored != key:
+                raise ValueError(f"{outfile} holds loops of a different A, U, V or matching; "
+                                 "remove it and its .progress file to start over")
+            L = load_eig_loops(outfile,mode='r+',complete=False)
+            if start: prev = L[:,0,start-1]
 
-    L = np.empty((n,m,l),dtype="complex")
-
-    B = lambda u: A(u,V[0])
-    L[:,:,0] = eig_trajectories(B,U)
-
-    if verbose: bar = IncrementalBar("Calculating\t", max=m,suffix='%(percent)d%%')
-    for i,v in enumerate(V[1:]):
-        B = lambda u: A(u,v)
-        E = eig_trajectories(B,U)
-        mask = list(range(n))
-        for traj in E:
-            idx = np.argmin(np.abs(traj[0]-L[:,0,i][mask]))
-            L[mask[idx],:,i+1] = traj
-            del mask[idx]
-        if verbose: bar.next()
-    if verbose: bar.next(); bar.finish()
+    stage = instrument(verbose).stage('solve',l,"Calculating\t")
+    if start: stage.goto(start)
+    for k,E in iter_eig_loops(A,U,V,batched,matching,workers,executor,start,prev,cache):
+        if L is None:
+            n,m = E.shape
+            if outfile is None:
+                L = np.empty((n,m,l),dtype="complex")
+            else:
+                # slices are stored contiguously, L is a transposed view
+                S = np.lib.format.open_memmap(outfile,mode='w+',dtype="complex",shape=(l,n,m))
+                L = S.transpose(1,2,0)
+        L[:,:,k] = E
+        if outfile is not None:
+            L.flush()
+            _write_progress(outfile,k+1,key)
+        stage.advance()
+    stage.finish()
     return L
 
-def eigenvector_trajectories(A,T,verbose=False):
+def _resume_key(A,U,V,batched,matching,key):
+    options = matching if isinstance(matching,str) else 'callable'
+    if key is not None:
+        return digest('eig_loops',key,U,V,batched,options)
+    try:
+        return _cache_key('eig_loops',A,U,V,batched,matching)
+    except TypeError as e:
+        warnings.warn(f"{e}; resuming eig_loops checks only U, V and the options, "
+                      "pass key= to identify A",stacklevel=3)
+        return digest('eig_loops',U,V,batched,options)
+
+def _progress_file(outfile):
+    return outfile+'.progress'
+
+def _read_progress(outfile,key=False):
+    # the sidecar holds the number of completed slices and the digest of the
+    # arguments they were computed from
+    with open(_progress_file(outfile)) as f:
+        k,_,stored = f.read().partition(' ')
+    return (int(k),stored.strip()) if key else int(k)
+
+def _write_progress(outfile,k,key):
+    tmp = _progress_file(outfile)+'.tmp'
+    with open(tmp,'w') as f:
+        f.write(f"{k} {key}")
+    os.replace(tmp,_progress_file(outfile))
+
+def load_eig_loops(outfile,mode='r',complete=True):
+    """Lazily loads eigenvalue loops written by eig_loops(...,outfile=outfile)
+
+    Parameters
+    ----------
+    outfile : str
+        The .npy file written by eig_loops
+    mode : str, optional
+        Memory-map mode (see numpy.load)
+    complete : bool, optional
+        If True, only the slices completed so far are returned
+
+    Returns
+    -------
+    L : ndarray
+        Memory-mapped array of eigenvalue loops, L[i,j,k] = the ith eigenvalue
+        of A(U[j],V[k])
+    """
+    S = np.load(outfile,mmap_mode=mode)
+    if complete and os.path.exists(_progress_file(outfile)):
+        S = S[:_read_progress(outfile)]
+    return S.transpose(1,2,0)
+
+def match_eigenvectors(P,v):
+    """Matches the eigenvectors v to the eigenvectors P by overlap, so that
+    v[:,perm] is the continuation of P. Both sets of columns must have unit norm.
+
+    Parameters
+    ----------
+    P : 2d array
+        Previous eigenvectors as columns
+    v : 2d array
+        New eigenvectors as columns
+
+    Returns
+    -------
+    perm : 1d array
+        Permutation maximizing the total overlap |<P[:,j],v[:,perm[j]]>|
+    """
+    O = np.abs(P.conj().T@v)
+    perm = np.argmax(O,axis=1)
+    if np.all(np.bincount(perm,minlength=v.shape[1])==1):
+        return perm
+    return linear_sum_assignment(O,maximize=True)[1]
+
+def eigenvector_trajectories(A,T,verbose=False,matching='greedy',select=None,
+        stride=1):
     """Computes the trajectories of the eigenvalues and eigenvectors of the
     matrix-valued function A(t)
 
@@ -91,6 +579,14 @@ def eigenvector_trajectories(A,T,verbose=False):
         Matrix-valued function of one parameter t
     T : 1d array
         Values of the parameter t
+    matching : str or callable, optional
+        Strategy for matching eigenvalues (see match_eigenvalues), or
+        'overlap' to match by eigenvector overlap (see match_eigenvectors)
+    select : 1d array of ints, optional
+        Indices (into the eigenvalues of A(T[0])) of the eigenvectors to store.
+        All eigenvectors are stored by default
+    stride : int, optional
+        Stores the eigenvectors only at every stride-th value of T
 
     Returns
     -------
@@ -99,26 +595,33 @@ def eigenvector_trajectories(A,T,verbose=False):
         trajectory of the ith eigenvalue as a 1d array
     V : ndarray
         Array of eigenvector trajectories where V[i] is the trajectory of the ith
-        eigenvector. V[:,i,k] = ith eigenvector of A(T[k])
+        eigenvector. V[:,i,k] = eigenvector select[i] of A(T[k*stride])
     """
-
-    n,m = A(T[0]).shape
+    M = A(T[0])
+    n,m = M.shape
     if n!=m:
         raise ValueError("Matrix must be square")
 
     m = len(T)
+    select = np.arange(n) if select is None else np.asarray(select)
     E = np.empty((n,m),dtype="complex")
-    V = np.empty((n,n,m),dtype="complex")
-    E[:,0], V[:,:,0] = la.eig(A(T[0]))
-    if verbose: bar = IncrementalBar("Calculating\t", max=m,suffix='%(percent)d%%')
+    V = np.empty((n,len(select),len(range(0,m,stride))),dtype="complex")
+    E[:,0], P = la.eig(M)
+    V[:,:,0] = P[:,select]
+    stage = instrument(verbose).stage('solve',m,"Calculating\t")
+    stage.advance()
     for i,t in enumerate(T[1:]):
         w,v = la.eig(A(t))
-        mask = list(range(n))
-        for eig in w:
-            idx = np.argmin(np.abs(eig-E[:,i][mask]))
-            E[mask[idx],i+1] = eig
-            V[:,mask[idx],i+1] = v[:,mask[idx]]*np.sign(v[:,mask[idx]]@V[:,mask[idx],i])
-            del mask[idx]
-        if verbose: bar.next()
-    if verbose: bar.next(); bar.finish()
+        if matching == 'overlap':
+            perm = match_eigenvectors(P,v)
+        else:
+            perm = match_eigenvalues(E[:,i],w,matching)
+        E[:,i+1] = w[perm]
+        v = v[:,perm]
+        # rotate the complex phase of each vector onto its predecessor
+        overlap = np.einsum('ij,ij->j',P.conj(),v)
+        P = v*np.exp(-1j*np.angle(overlap))
+        if (i+1)%stride == 0: V[:,:,(i+1)//stride] = P[:,select]
+        stage.advance()
+    stage.finish()
     return E,V
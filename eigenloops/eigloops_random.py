@@ -4,7 +4,10 @@ import eigenani as ea
 
 if __name__ == "__main__":
     n = int(argv[1])
+    workers = int(argv[3]) if len(argv) > 3 else None
     M1,M2,M3 = np.random.randn(3,n,n)+1j*np.random.randn(3,n,n)
-    A = lambda u,v: M1 + .1*np.exp(1j*u)*M2 + .05*np.exp(1j*v)*M3
+    # u may be the whole parameter array, so broadcast it over the matrices
+    A = lambda u,v: M1 + .1*np.exp(1j*u)[...,None,None]*M2 + .05*np.exp(1j*v)*M3
     U = np.linspace(0,2*np.pi,200)
-    ea.animate_eig_loops(A,U,U,argv[2],verbose=True)
+    ea.animate_eig_loops(A,U,U,argv[2],verbose=True,batched=True,
+                         workers=workers)
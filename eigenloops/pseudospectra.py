@@ -0,0 +1,209 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import numpy as np
+import scipy.linalg as la
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+import eigentools as et
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from eigenfun.instrument import instrument
+
+def _svd_sigma_min(T,Z,chunk):
+    """Smallest singular values of zI-T for the points Z, from batched dense
+    SVDs of `chunk` shifted matrices at a time"""
+    n = T.shape[0]
+    S = np.empty(len(Z))
+    I = np.eye(n)
+    for k in range(0,len(Z),chunk):
+        M = Z[k:k+chunk,np.newaxis,np.newaxis]*I-T
+        S[k:k+chunk] = np.linalg.svd(M,compute_uv=False)[:,-1]
+    return S
+
+def _lanczos_sigma_min(T,z,q,tol=1e-3,maxiter=99):
+    """Smallest singular value of zI-T for upper triangular T by Lanczos
+    iteration on ((zI-T)(zI-T)^H)^-1, two triangular solves per step"""
+    n = T.shape[0]
+    T1 = T-z*np.eye(n)
+    qold = np.zeros(n,dtype=complex)
+    alpha,beta = [],[0.]
+    sig = 0
+    for k in range(min(maxiter,n)):
+        v = la.solve_triangular(T1,la.solve_triangular(T1,q,trans='C'))
+        v = v-beta[-1]*qold
+        alpha.append(np.real(np.vdot(q,v)))
+        v = v-alpha[-1]*q
+        beta.append(la.norm(v))
+        sigold,sig = sig,la.eigvalsh_tridiagonal(alpha,beta[1:-1],select='i',
+                                                 select_range=(k,k))[0]
+        if abs(sigold/sig-1) < tol or beta[-1] == 0:
+            break
+        qold,q = q,v/beta[-1]
+    return 1/np.sqrt(sig)
+
+def sigma_min(A,x,y,method='auto',workers=None,chunk=None,verbose=False,seed=0,tol=1e-3):
+    """Computes the smallest singular value of zI-A at every point z=x+iy of a
+    grid. The epsilon-pseudospectrum of A is the region where it is below
+    epsilon, so contouring the result at the levels epsilon draws the
+    pseudospectra.
+
+    A is reduced once to its complex Schur form A=QTQ^H, which has the same
+    singular values of zI-T at every z.
+
+    Parameters
+    ----------
+    A : 2d array
+        Square matrix
+    x, y : 1d array
+        Real and imaginary parts of the grid points
+    method : str, optional
+        'svd' for batched dense SVDs of zI-T, vectorized over the grid (best
+        for small matrices), 'lanczos' for inverse Lanczos iteration, which
+        does two O(n^2) triangular solves per iteration, or 'auto' to pick
+        'svd' for n <= 64
+    workers : int, optional
+        If greater than 1, the grid points are spread over a pool of this
+        many threads (BLAS is pinned to one thread per worker if
+        threadpoolctl is installed)
+    chunk : int, optional
+        Number of grid points per batched SVD
+    seed : int, optional
+        Seed of the Lanczos starting vector
+    tol : float, optional
+        Relative change of the Lanczos estimate at which the iteration stops,
+        roughly its relative error
+
+    Returns
+    -------
+    S : ndarray
+        Array of shape (len(y),len(x)) where S[j,k] is the smallest singular
+        value of (x[k]+iy[j])I-A
+    """
+    A = np.asarray(A)
+    if A.ndim != 2 or A.shape[0] != A.shape[1]:
+        raise ValueError("Matrix must be square")
+    n = A.shape[0]
+    T = la.schur(A.astype(complex),output='complex')[0]
+    Z = (np.asarray(x)[np.newaxis,:]+1j*np.asarray(y)[:,np.newaxis]).ravel()
+    if method == 'auto':
+        method = 'svd' if n <= 64 else 'lanczos'
+    if method == 'svd':
+        chunk = max(1,2**22//n**2) if chunk is None else chunk
+        blocks = [Z[k:k+chunk] for k in range(0,len(Z),chunk)]
+        solve = lambda Z: _svd_sigma_min(T,Z,chunk)
+    elif method == 'lanczos':
+        rng = np.random.default_rng(seed)
+        q = rng.standard_normal(n)+1j*rng.standard_normal(n)
+        q /= la.norm(q)
+        blocks = list(Z)
+        solve = lambda z: _lanczos_sigma_min(T,z,q,tol)
+    else:
+        raise ValueError(f"Unknown method '{method}'")
+
+    pool = None
+    if workers is not None and workers > 1:
+        pool = ThreadPoolExecutor(workers)
+    if pool is not None and threadpool_limits is not None:
+        limits = threadpool_limits(limits=1)
+    else:
+        limits = nullcontext()
+    # progress is counted in grid points for both methods
+    stage = instrument(verbose).stage('solve',len(Z),"Pseudospectra\t")
+    S = []
+    try:
+        with limits:
+            for s in (pool.map(solve,blocks) if pool is not None else map(solve,blocks)):
+                S.append(s)
+                stage.advance(np.size(s))
+    finally:
+        if pool is not None: pool.shutdown()
+    stage.finish()
+    return np.hstack(S).reshape(len(y),len(x))
+
+def condition_numbers(A):
+    """Computes the eigenvalues of A and their condition numbers
+    kappa = 1/|y^H x| for unit left and right eigenvectors y and x. To first
+    order, a perturbation of norm epsilon moves each eigenvalue by at most
+    epsilon*kappa, so the epsilon-pseudospectrum is approximately the union
+    of the disks of these radii.
+
+    Returns
+    -------
+    w : 1d array
+        Eigenvalues of A
+    kappa : 1d array
+        Condition numbers of the eigenvalues, huge or inf for defective ones
+    """
+    w,vl,vr = la.eig(A,left=True)
+    vl /= la.norm(vl,axis=0)
+    vr /= la.norm(vr,axis=0)
+    with np.errstate(divide='ignore'):
+        kappa = 1/np.abs(np.sum(vl.conj()*vr,axis=0))
+    return w,kappa
+
+def first_order_perturbation(A,F,epsilons):
+    """Computes the first-order approximations w + epsilon*(y^H F x)/(y^H x)
+    of the eigenvalues of A+epsilon*F
+
+    Returns
+    -------
+    W : ndarray
+        Array of shape (len(epsilons),n) where W[k] approximates the
+        eigenvalues of A+epsilons[k]*F
+    """
+    w,vl,vr = la.eig(A,left=True)
+    shift = np.sum(vl.conj()*(F@vr),axis=0)/np.sum(vl.conj()*vr,axis=0)
+    return w+np.asarray(epsilons)[:,np.newaxis]*shift
+
+def perturbation_ensemble(A,epsilons,samples=10,F=None,matching='greedy',workers=None,seed=0):
+    """Computes the eigenvalue trajectories of A+epsilon*F for an ensemble of
+    perturbations F. The eigenvalues for all epsilons of one perturbation are
+    computed in one batched call and matched along epsilon (see
+    eigentools.eig_trajectories).
+
+    Parameters
+    ----------
+    A : 2d array
+        Square matrix
+    epsilons : 1d array
+        Perturbation sizes, starting at 0 for the trajectories to start at the
+        eigenvalues of A
+    samples : int, optional
+        Number of random perturbations, used if F is None
+    F : ndarray, optional
+        Array of shape (samples,n,n) of perturbations. By default they are
+        drawn uniformly from [-1,1] and scaled to unit 2-norm
+    matching : str or callable, optional
+        Strategy for matching eigenvalues between consecutive epsilons (see
+        eigentools.match_eigenvalues)
+    workers : int, optional
+        If greater than 1, the perturbations are spread over a pool of this
+        many threads
+    seed : int, optional
+        Seed of the random perturbations
+
+    Returns
+    -------
+    E : ndarray
+        Array of shape (samples,n,len(epsilons)) where E[s,i] is the
+        trajectory of the ith eigenvalue under the sth perturbation
+    F : ndarray
+        The perturbations
+    """
+    A = np.asarray(A)
+    n = A.shape[0]
+    if F is None:
+        F = 2*np.random.default_rng(seed).random((samples,n,n))-1
+        F /= np.linalg.norm(F,ord=2,axis=(1,2))[:,np.newaxis,np.newaxis]
+    epsilons = np.asarray(epsilons)
+    trajectories = lambda F: et.eig_trajectories(
+        lambda e: A+e[:,np.newaxis,np.newaxis]*F,epsilons,batched=True,matching=matching)
+    if workers is not None and workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            E = list(pool.map(trajectories,F))
+    else:
+        E = [trajectories(f) for f in F]
+    return np.array(E),F
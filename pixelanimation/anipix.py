@@ -1,24 +1,167 @@
 USAGE = """USAGE
 
-$ python anipix.py [imfile1] [imfile2] [outfile] [--color]
+$ python anipix.py [imfile1] [imfile2] [outfile] [--color] [--lazy] [--raster] [--transport]
+
+$ python anipix.py --batch [manifest] [--workers N] [--color] [--lazy] [--raster] [--transport]
 
 [outfile] must be .mp4
 
 [--c] is an optional flag to use color mode (slower)
 
+[--lazy] is an optional flag to interpolate frames as they are drawn, which
+keeps memory use low for large images
+
+[--raster] is an optional flag to draw frames straight into a framebuffer
+instead of with matplotlib (much faster for large images)
+
+[--transport] is an optional flag to pair pixels by both color and position,
+which gives shorter, smoother pixel paths
+
+[--batch] renders every job in [manifest], a CSV file with one
+imfile1,imfile2,outfile job per line (lines starting with # are skipped).
+Each image is read and sorted once however many jobs use it (with
+[--transport], each pair of images is matched once), the jobs run on
+[--workers N] processes (default: one per CPU), and a failed job or malformed
+line is reported without stopping the others
+
 Examples:
 
     $ python anipix.py cameraman.png lena.png gray.mp4
 
     $ python anipix.py peppers.png mandrill.png color.mp4 --c
+
+    $ python anipix.py --batch jobs.csv --workers 8
 """
 
+def read_manifest(manifest):
+    """Reads the (imfile1,imfile2,outfile) jobs of a batch manifest. Returns
+    the jobs and the (line number,error) of every malformed line."""
+    import csv
+    jobs,bad = [],[]
+    with open(manifest,newline='') as f:
+        for lineno,row in enumerate(csv.reader(f),1):
+            row = [field.strip() for field in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if len(row) != 3:
+                bad.append((lineno,ValueError(f"Bad manifest line: {','.join(row)}")))
+            else:
+                jobs.append(tuple(row))
+    return jobs,bad
+
+def prepare_image(imfile,color,sort=True):
+    """Reads and, unless sort is False, sorts one image for the batch, shared
+    by all its jobs"""
+    import pixelanimation as pa
+    image = pa.load_image(imfile,color)
+    return image,(pa.image_coords(image,color) if sort else None)
+
+def prepare_pair(prepared1,prepared2):
+    """Matches two prepared images by transport, shared by all jobs of the pair"""
+    import pixelanimation as pa
+    (img1,_),(img2,_) = prepared1,prepared2
+    _check_pixels(img1,img2)
+    return pa.transport_coords(img1,img2)
+
+def _check_pixels(img1,img2):
+    if img1.shape[0]*img1.shape[1] != img2.shape[0]*img2.shape[1]:
+        raise ValueError("Images must have the name number of pixels")
+
+def render_job(prepared1,prepared2,outfile,color,options,coords=None):
+    """Renders one batch job from two prepared images, or from the coords of
+    their matched pair, returning its run time"""
+    import time
+    import pixelanimation as pa
+    start = time.perf_counter()
+    (img1,coords1),(img2,coords2) = prepared1,prepared2
+    _check_pixels(img1,img2)
+    if coords is not None:
+        coords1,coords2 = coords
+    pa.render_pixels(coords1,coords2,img1.shape,img2.shape,outfile,color,
+                     lazy=options.get('lazy',False),renderer=options.get('renderer','scatter'))
+    return time.perf_counter()-start
+
+def _results(futures):
+    """The result, or the exception, of every future of a dict"""
+    results = {}
+    for key,future in futures.items():
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            results[key] = e
+    return results
+
+def run_batch(manifest,color=False,workers=None,**options):
+    """Runs every job of a batch manifest on a process pool, printing the time
+    or error of each job. Returns the number of failed jobs."""
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs,bad = read_manifest(manifest)
+    for lineno,e in bad:
+        print(f"FAILED\t\t\tline {lineno}: {type(e).__name__}: {e}")
+    transport = options.get('matching') == 'transport'
+    images = sorted({imfile for job in jobs for imfile in job[:2]})
+    failed = len(bad)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as executor:
+        # transport matching replaces the sort, and is computed once per pair
+        prepared = _results({imfile:executor.submit(prepare_image,imfile,color,not transport)
+                             for imfile in images})
+        pairs = {}
+        if transport:
+            pairs = {job[:2] for job in jobs
+                     if not any(isinstance(prepared[f],Exception) for f in job[:2])}
+            pairs = _results({pair:executor.submit(prepare_pair,*(prepared[f] for f in pair))
+                              for pair in sorted(pairs)})
+
+        futures = []
+        for imfile1,imfile2,outfile in jobs:
+            errors = [prepared[f] for f in (imfile1,imfile2) if isinstance(prepared[f],Exception)]
+            coords = pairs.get((imfile1,imfile2))
+            if isinstance(coords,Exception): errors.append(coords)
+            if errors:
+                futures.append((outfile,errors[0]))
+            else:
+                futures.append((outfile,executor.submit(render_job,prepared[imfile1],
+                                prepared[imfile2],outfile,color,options,coords)))
+        for outfile,future in futures:
+            try:
+                if isinstance(future,Exception):
+                    raise future
+                print(f"done\t{future.result():8.2f}s\t{outfile}")
+            except Exception as e:
+                failed += 1
+                print(f"FAILED\t\t\t{outfile}: {type(e).__name__}: {e}")
+    print(f"{len(jobs)+len(bad)-failed}/{len(jobs)+len(bad)} jobs done in {time.perf_counter()-start:.2f}s")
+    return failed
+
 
 if __name__ == "__main__":
     from sys import argv
-    import pixelanimation as pa
 
-    if len(argv) < 4 or "--help" in argv:
+    lazy = "--lazy" in argv
+    renderer = "raster" if "--raster" in argv else "scatter"
+    matching = "transport" if "--transport" in argv else "sort"
+
+    if "--batch" in argv:
+        i = argv.index("--batch")
+        if i+1 >= len(argv):
+            print(USAGE)
+        else:
+            workers = None
+            if "--workers" in argv:
+                j = argv.index("--workers")
+                if j+1 >= len(argv) or not argv[j+1].isdigit() or int(argv[j+1]) < 1:
+                    print("Bad input: [--workers] must be followed by a positive number\n")
+                    print(USAGE)
+                    raise SystemExit(1)
+                workers = int(argv[j+1])
+            failed = run_batch(argv[i+1],color="--c" in argv,workers=workers,lazy=lazy,
+                               renderer=renderer,matching=matching)
+            raise SystemExit(1 if failed else 0)
+
+    elif len(argv) < 4 or "--help" in argv:
         print(USAGE)
 
     elif argv[3][-4:] != ".mp4":
@@ -26,8 +169,11 @@ if __name__ == "__main__":
         print(USAGE)
 
     else:
+        import pixelanimation as pa
         if "--c" in argv:
             print("Using color mode")
-            pa.animate_pixels(argv[1],argv[2],argv[3],verbose=True,color=True)
+            pa.animate_pixels(argv[1],argv[2],argv[3],verbose=True,color=True,lazy=lazy,
+                              renderer=renderer,matching=matching)
         else:
-            pa.animate_pixels(argv[1],argv[2],argv[3],verbose=True)
+            pa.animate_pixels(argv[1],argv[2],argv[3],verbose=True,lazy=lazy,
+                              renderer=renderer,matching=matching)
@@ -1,10 +1,20 @@
+import os
+import sys
+from functools import partial
 import numpy as np
 import scipy.linalg as la
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from matplotlib.colors import rgb_to_hsv
-from imageio import imread
-from progress.bar import IncrementalBar
+from scipy.optimize import linear_sum_assignment
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from eigenfun.segments import render_parallel
+from eigenfun.framepipe import FramePipe, encoder_args, ffmpeg_writer
+from eigenfun.instrument import instrument
+
+# n is number of frames of one-directional transition
+# buffer is number of stationary frames before and after the transitions
+# total is number of frames for two transitions with 2 buffer periods each
+n = 100
+buffer = 10
+total = 2*n+4*buffer
 
 def grayscale_to_coords(image):
     """Sorts a grayscale image's pixels by saturation, and returns arrays
@@ -20,6 +30,7 @@ def color_to_coords(image):
     """Sorts a color image's pixels by hue, and returns arrays containing the
     row and column positions corresponding to sorted order, as well as the
     sorted rgb values as a Nx3 array."""
+    from matplotlib.colors import rgb_to_hsv
 
     rot_image = np.rot90(image,k=-1)
     hue = rgb_to_hsv(rot_image)[:,:,0]
@@ -28,7 +39,178 @@ def color_to_coords(image):
     colors = rot_image.reshape((rot_image.shape[0]*rot_image.shape[1],3))[mask]
     return rows,cols,colors
 
-def animate_pixels(imfile1,imfile2,outfile,color=False,verbose=False):
+def load_image(imfile,color=False):
+    """Reads an image as an array of floats in [0,1], converted to grayscale
+    unless color is True"""
+    from imageio import imread
+    if color:
+        return np.array(imread(imfile))/255
+    return np.array(imread(imfile,as_gray=True))/255
+
+def image_coords(image,color=False):
+    """Sorts an image's pixels with color_to_coords if color is True, or
+    grayscale_to_coords otherwise"""
+    if color:
+        return color_to_coords(image)
+    return grayscale_to_coords(image)
+
+def transport_match(F1,F2,block=64):
+    """Approximately solves the optimal transport (assignment) problem between
+    two equally sized point sets in near-linear time. Both sets are split
+    coarse-to-fine at the median of the coordinate with the largest spread,
+    and the blocks of at most `block` points are matched exactly.
+
+    Parameters
+    ----------
+    F1, F2 : ndarray
+        NxD arrays of points
+    block : int, optional
+        Size of the blocks solved with an exact linear assignment
+
+    Returns
+    -------
+    perm : 1d array
+        Permutation such that F2[perm[i]] is matched to F1[i]
+    """
+    perm = np.empty(len(F1),dtype=int)
+    stack = [(np.arange(len(F1)),np.arange(len(F2)))]
+    while stack:
+        i1,i2 = stack.pop()
+        if len(i1) <= block:
+            D = ((F1[i1,np.newaxis,:]-F2[np.newaxis,i2,:])**2).sum(axis=2)
+            r,c = linear_sum_assignment(D)
+            perm[i1[r]] = i2[c]
+            continue
+        lo = np.minimum(F1[i1].min(axis=0),F2[i2].min(axis=0))
+        hi = np.maximum(F1[i1].max(axis=0),F2[i2].max(axis=0))
+        axis = np.argmax(hi-lo)
+        h = len(i1)//2
+        o1 = np.argpartition(F1[i1,axis],h)
+        o2 = np.argpartition(F2[i2,axis],h)
+        stack.append((i1[o1[:h]],i2[o2[:h]]))
+        stack.append((i1[o1[h:]],i2[o2[h:]]))
+    return perm
+
+def transport_coords(image1,image2,weight=1.,block=64):
+    """Pairs the pixels of two images with the same number of pixels by
+    (approximately) minimizing the total squared distance in color and
+    position, so that pixels travel shorter paths than when sorting by
+    intensity or hue alone.
+
+    Parameters
+    ----------
+    image1, image2 : ndarray
+        Grayscale (2d) or color (3d) images with values in [0,1]
+    weight : float, optional
+        Weight of the spatial distance, in units of the image size, relative
+        to the color distance. 0 matches by color alone
+    block : int, optional
+        Block size of the exact matching (see transport_match)
+
+    Returns
+    -------
+    coords1, coords2 : tuple
+        The rows, columns and colors of the paired pixels of each image, in
+        the same form as returned by grayscale_to_coords or color_to_coords
+    """
+    def features(image):
+        rot_image = np.rot90(image,k=-1)
+        rows,cols = np.indices(rot_image.shape[:2]).reshape(2,-1)
+        colors = rot_image.reshape(rows.size,-1)
+        scale = weight/max(rot_image.shape[:2])
+        F = np.column_stack((colors,scale*rows,scale*cols))
+        return (rows,cols,colors.reshape(rows.size,*rot_image.shape[2:])),F
+
+    (rows1,cols1,colors1),F1 = features(image1)
+    (rows2,cols2,colors2),F2 = features(image2)
+    perm = transport_match(F1,F2,block)
+    return (rows1,cols1,colors1),(rows2[perm],cols2[perm],colors2[perm])
+
+def transition_index(j):
+    """Returns the index into the n interpolated transition frames shown in
+    frame j of the animation"""
+    if j < buffer:
+        return 0
+    elif j < buffer+n:
+        return j-buffer
+    elif j < 3*buffer+n:
+        return n-1
+    elif j < 3*buffer+2*n:
+        return n-(j-(3*buffer+n))-1
+    return 0
+
+def splat_pixels(pos,colors,extent,resolution,splat='nearest',background=1.):
+    """Splats pixels straight into an RGB framebuffer. Each pixel is a unit
+    square centered at its position, in the coordinates of the scatter plot
+    drawn by render_pixels (x along the image columns, y up the image rows).
+
+    Parameters
+    ----------
+    pos : ndarray
+        Nx2 array of pixel centers
+    colors : ndarray
+        Intensities as a length N array, or rgb values as a Nx3 array
+    extent : tuple
+        Width and height of the plotted region in image pixels
+    resolution : tuple
+        Width and height of the framebuffer
+    splat : str, optional
+        'nearest' writes each sample to the framebuffer pixel containing it,
+        'bilinear' spreads it over the four nearest framebuffer pixels
+    background : float, optional
+        Intensity of framebuffer pixels no sample lands on
+
+    Returns
+    -------
+    frame : ndarray
+        Array of shape (height,width,3) and dtype uint8
+    """
+    W,H = extent
+    w,h = resolution
+    sx,sy = w/W,h/H
+    colors = np.asarray(colors).reshape(len(pos),-1)
+    acc = np.zeros((colors.shape[1],w*h))
+    weight = np.zeros(w*h)
+
+    def accumulate(ix,iy,wt):
+        valid = (ix >= 0)&(ix < w)&(iy >= 0)&(iy < h)
+        flat = (iy*w+ix)[valid]
+        wt = wt[valid]
+        weight[:] += np.bincount(flat,wt,minlength=w*h)
+        for k in range(colors.shape[1]):
+            acc[k] += np.bincount(flat,wt*colors[valid,k],minlength=w*h)
+
+    # top left corner of each pixel's square in framebuffer pixels; squares
+    # larger than a framebuffer pixel are sampled at kx*ky points
+    x0 = (pos[:,0]-.5)*sx
+    y0 = (H-pos[:,1]-.5)*sy
+    kx,ky = max(1,int(round(sx))),max(1,int(round(sy)))
+    for a in range(kx):
+        for b in range(ky):
+            px = x0+(a+.5)*sx/kx
+            py = y0+(b+.5)*sy/ky
+            if splat == 'nearest':
+                accumulate(np.floor(px).astype(int),np.floor(py).astype(int),np.ones(len(pos)))
+            elif splat == 'bilinear':
+                fx,fy = px-.5,py-.5
+                ix,iy = np.floor(fx).astype(int),np.floor(fy).astype(int)
+                tx,ty = fx-ix,fy-iy
+                accumulate(ix,iy,(1-tx)*(1-ty))
+                accumulate(ix+1,iy,tx*(1-ty))
+                accumulate(ix,iy+1,(1-tx)*ty)
+                accumulate(ix+1,iy+1,tx*ty)
+            else:
+                raise ValueError(f"Unknown splat '{splat}'")
+
+    frame = np.full(acc.shape,float(background))
+    covered = weight > 0
+    frame[:,covered] = acc[:,covered]/weight[covered]
+    frame = np.clip(frame*255+.5,0,255).astype(np.uint8).reshape(-1,h,w)
+    return np.ascontiguousarray(np.broadcast_to(frame,(3,h,w)).transpose(1,2,0))
+
+def animate_pixels(imfile1,imfile2,outfile,color=False,verbose=False,render_workers=None,
+        lazy=False,renderer='scatter',splat='nearest',resolution=None,matching='sort',
+        weight=1.,lossless=False):
     """Animates a pixel-motion transition between two images. Images must have
     the exact same number of pixels. Animation is saved as "outfile".
 
@@ -42,37 +224,108 @@ def animate_pixels(imfile1,imfile2,outfile,color=False,verbose=False):
         The output file name
     color : bool, optional
         If True, runs in color mode
-    verbose : bool, optional
-        If True, displays a progress bar in the console
+    verbose : bool, Instrument or callable, optional
+        If True, displays a progress bar in the console. An
+        eigenfun.instrument.Instrument or a callable receives the timing and
+        progress events of every stage instead
+    render_workers : int, optional
+        If greater than 1, the frames are rendered in this many processes as
+        separate lossless segments, which are then joined and encoded once
+        into the same video as a serial render (see
+        eigenfun.segments.render_parallel)
+    lazy : bool, optional
+        If True, interpolates each frame only when it is drawn instead of
+        precomputing all of them (see render_pixels)
+    renderer : str, optional
+        'scatter' draws the pixels with matplotlib, 'raster' splats them into a
+        framebuffer streamed to ffmpeg (see render_pixels)
+    splat : str, optional
+        'nearest' or 'bilinear' splatting for the raster renderer
+    resolution : tuple, optional
+        Width and height of the video for the raster renderer
+    matching : str, optional
+        'sort' pairs the pixels by sorting intensity (or hue), 'transport'
+        pairs them by distance in both color and position (see
+        transport_coords)
+    weight : float, optional
+        Weight of the spatial distance for 'transport' matching
+    lossless : bool, optional
+        If True, the yuv420p frames are encoded without loss (libx264 at
+        quantizer 0), which gives much larger files that many players cannot
+        decode. The joined segments are then kept as they are
     """
 
     # Read in images
-    if color:
-        img1 = np.array(imread(imfile1))/255
-        img2 = np.array(imread(imfile2))/255
-    else:
-        img1 = np.array(imread(imfile1,as_gray=True))/255
-        img2 = np.array(imread(imfile2,as_gray=True))/255
+    img1 = load_image(imfile1,color)
+    img2 = load_image(imfile2,color)
 
     # Check number of pixels
     if img1.shape[0]*img1.shape[1] != img2.shape[0]*img2.shape[1]:
         raise ValueError("Images must have the name number of pixels")
 
     # Sort pixels by saturation (if grayscale) or hue (if color)
-    if verbose: bar1 = IncrementalBar("Sorting\t\t", max=2,suffix='%(percent)d%%')
-    if color: rows1,cols1,colors1 = color_to_coords(img1)
-    else: rows1,cols1,colors1 = grayscale_to_coords(img1)
-    if verbose: bar1.next()
-    if color: rows2,cols2,colors2 = color_to_coords(img2)
-    else: rows2,cols2,colors2 = grayscale_to_coords(img2)
-    if verbose: bar1.next(); bar1.finish()
-
-    # n is number of frames of one-directional transition
-    # buffer is number of stationary frames before and after the transitions
-    # total is number of frames for two transitions with 2 buffer periods each
-    n=100
-    buffer = 10
-    total = 2*n+4*buffer
+    stage = instrument(verbose).stage('sort',2,"Sorting\t\t")
+    if matching == 'transport':
+        coords1,coords2 = transport_coords(img1,img2,weight)
+    else:
+        coords1 = image_coords(img1,color)
+        stage.advance()
+        coords2 = image_coords(img2,color)
+    stage.finish(2)
+
+    if render_workers is not None and render_workers > 1:
+        render = partial(render_pixels,coords1,coords2,img1.shape,img2.shape,color=color,
+                         lazy=lazy,renderer=renderer,splat=splat,resolution=resolution)
+        render_parallel(render,total,outfile,render_workers,
+                        encode=None if lossless else encoder_args())
+    else:
+        render_pixels(coords1,coords2,img1.shape,img2.shape,outfile,color,verbose=verbose,
+                      lazy=lazy,renderer=renderer,splat=splat,resolution=resolution,
+                      lossless=lossless)
+
+def render_pixels(coords1,coords2,shape1,shape2,outfile,color=False,frames=None,
+        verbose=False,lazy=False,renderer='scatter',splat='nearest',resolution=None,
+        lossless=False):
+    """Renders the pixel-motion transition between two sorted images (see
+    animate_pixels).
+
+    Parameters
+    ----------
+    coords1, coords2 : tuple
+        The rows, columns and colors of the sorted pixels of each image, as
+        returned by grayscale_to_coords or color_to_coords
+    shape1, shape2 : tuple
+        The shapes of the two images
+    outfile : str
+        The output file name
+    color : bool, optional
+        If True, runs in color mode
+    frames : range, optional
+        The frames to render. All of them by default
+    verbose : bool, Instrument or callable, optional
+        Progress and timing reporting (see animate_pixels)
+    lazy : bool, optional
+        If True, each frame's positions and colors are interpolated when it is
+        drawn, in place into preallocated buffers, so memory use does not
+        grow with the number of frames. The arithmetic is that of the
+        precomputed frames, so both render the same pixels
+    renderer : str, optional
+        'scatter' draws each pixel as a square marker in a matplotlib scatter
+        plot. 'raster' splats the pixels into a framebuffer (see splat_pixels)
+        and streams it to ffmpeg without matplotlib
+    splat : str, optional
+        'nearest' or 'bilinear' splatting for the raster renderer
+    resolution : tuple, optional
+        Width and height of the video for the raster renderer. Defaults to one
+        video pixel per image pixel
+    lossless : bool, optional
+        If True, encodes without loss (see animate_pixels)
+    """
+    rows1,cols1,colors1 = coords1
+    rows2,cols2,colors2 = coords2
+    frames = range(total) if frames is None else frames
+    log = instrument(verbose)
+    qp = 0 if lossless else None
 
     # np.linspace creates evenly spaced position and color arrays for transition
     # if verbose: bar2 = IncrementalBar("Interpolating\t",max=4,suffix='%(percent)d%%')
@@ -86,23 +339,65 @@ def animate_pixels(imfile1,imfile2,outfile,color=False,verbose=False):
     # if verbose: bar2.next(); bar2.finish()
 
     # testing consine transition
-    if verbose: bar2 = IncrementalBar("Interpolating\t",max=4,suffix='%(percent)d%%')
     t = np.linspace(0,1,n)
-    cos = -0.5*(np.cos(np.pi*t)-1)[:,np.newaxis]
-    if color: cos = cos[:,:,np.newaxis]
-    colors = (1-cos)*colors1[np.newaxis] + cos*colors2[np.newaxis]
-    if color: cos = cos[:,:,0]
-    if verbose: bar2.next()
-    rows = (1-cos)*(rows1+.5)[np.newaxis] + cos*(rows2+.5)[np.newaxis]
-    if verbose: bar2.next()
-    cols = (1-cos)*(cols1+.5)[np.newaxis] + cos*(cols2+.5)[np.newaxis]
-    if verbose: bar2.next()
-    pos = np.dstack((rows,cols))
-    if verbose: bar2.next(); bar2.finish()
+    if lazy:
+        # float64 and the same expression as below: float32 moves pixels
+        # across cell boundaries
+        cos = -0.5*(np.cos(np.pi*t)-1)
+        start = np.column_stack((rows1,cols1))+.5
+        end = np.column_stack((rows2,cols2))+.5
+        cstart = np.asarray(colors1,dtype=float)
+        cend = np.asarray(colors2,dtype=float)
+        pos_buf,pos_tmp = np.empty_like(start),np.empty_like(start)
+        col_buf,col_tmp = np.empty_like(cstart),np.empty_like(cstart)
+
+        def interpolate(i):
+            np.multiply(1-cos[i],start,out=pos_buf)
+            np.add(pos_buf,np.multiply(cos[i],end,out=pos_tmp),out=pos_buf)
+            np.multiply(1-cos[i],cstart,out=col_buf)
+            np.add(col_buf,np.multiply(cos[i],cend,out=col_tmp),out=col_buf)
+            return pos_buf,col_buf
+    else:
+        stage = log.stage('interpolate',4,"Interpolating\t")
+        cos = -0.5*(np.cos(np.pi*t)-1)[:,np.newaxis]
+        if color: cos = cos[:,:,np.newaxis]
+        colors = (1-cos)*colors1[np.newaxis] + cos*colors2[np.newaxis]
+        if color: cos = cos[:,:,0]
+        stage.advance()
+        rows = (1-cos)*(rows1+.5)[np.newaxis] + cos*(rows2+.5)[np.newaxis]
+        stage.advance()
+        cols = (1-cos)*(cols1+.5)[np.newaxis] + cos*(cols2+.5)[np.newaxis]
+        stage.advance()
+        pos = np.dstack((rows,cols))
+        stage.finish(4)
+        interpolate = lambda i: (pos[i],colors[i])
+
+    if renderer == 'raster':
+        extent = (max(shape1[1],shape2[1]),max(shape1[0],shape2[0]))
+        w,h = extent if resolution is None else resolution
+        # lazily interpolated frames are timed as part of drawing
+        draw = log.stage('draw',len(frames),"Rendering\t")
+        encode = log.stage('encode',len(frames))
+        # same frame rate as the 60-millisecond interval of the scatter renderer
+        with FramePipe(outfile,w,h,fps=1000/60,qp=qp) as pipe:
+            for j in frames:
+                with draw.timed():
+                    pos_j,colors_j = interpolate(transition_index(j))
+                    frame = splat_pixels(pos_j,colors_j,extent,(w,h),splat)
+                with encode.timed():
+                    pipe.write(frame)
+                draw.advance()
+                encode.advance()
+        draw.finish()
+        encode.finish()
+        return
+
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
 
     # Calculate the aspect ratio of the two images
-    aspect_ratio1 = img1.shape[0]/img1.shape[1]
-    aspect_ratio2 = img2.shape[0]/img2.shape[1]
+    aspect_ratio1 = shape1[0]/shape1[1]
+    aspect_ratio2 = shape2[0]/shape2[1]
 
     plt.ioff()
     inches = 5
@@ -113,45 +408,39 @@ def animate_pixels(imfile1,imfile2,outfile,color=False,verbose=False):
             hspace = 0, wspace = 0)
     plt.margins(0)
     plt.axis("off")
-    plt.xlim((0,max(img1.shape[1],img2.shape[1])))
-    plt.ylim((0,max(img1.shape[0],img2.shape[0])))
+    plt.xlim((0,max(shape1[1],shape2[1])))
+    plt.ylim((0,max(shape1[0],shape2[0])))
 
     # Markers are measured in points, which are 1/72nd of an inch. Calculates
     # pixel size in points
-    pixels = max(img1.shape[1],img2.shape[1])
+    pixels = max(shape1[1],shape2[1])
     pixels_per_inch = pixels/inches
     size = 72/pixels_per_inch
 
     # core object is a scatter plot with square markers set to pixel size
+    pos0,_ = interpolate(0)
     if color:
-        points = ax.scatter(rows[0],cols[0],c=colors1,marker='s',s=size**2,linewidths=0)
+        points = ax.scatter(pos0[:,0],pos0[:,1],c=colors1,marker='s',s=size**2,linewidths=0)
     else:
-        points = ax.scatter(rows[0],cols[0],c=colors1,cmap="gray",marker='s',s=size**2,vmin=0,vmax=1,linewidths=0)
+        points = ax.scatter(pos0[:,0],pos0[:,1],c=colors1,cmap="gray",marker='s',s=size**2,vmin=0,vmax=1,linewidths=0)
     # plt.savefig('pixeltest.jpg')
     # return 0
 
     # update function changes the scatter plot at each frame
     # set_color works for rgb, set_array works for grayscale
+    # every frame sets its full state so that any range of frames can be
+    # rendered on its own
     def update(j):
-        if j >= buffer and j < buffer+n:
-            i = j-buffer
-            points.set_offsets(pos[i])
-            if color: points.set_color(colors[i])
-            else: points.set_array(colors[i])
-        elif j >= 3*buffer+n and j < 3*buffer+2*n:
-            i = n-(j-(3*buffer+n))-1
-            points.set_offsets(pos[i])
-            if color: points.set_color(colors[i])
-            else: points.set_array(colors[i])
-        if verbose: bar3.next()
-
-    if verbose: bar3 = IncrementalBar("Rendering\t",max=total,suffix='%(percent)d%%')
+        pos_i,colors_i = interpolate(transition_index(j))
+        points.set_offsets(pos_i)
+        if color: points.set_color(colors_i)
+        else: points.set_array(colors_i)
 
     # Create FuncAnimation with 60-millisecond inteval between frames
-    ani = animation.FuncAnimation(fig,update,frames=total,interval=60)
+    with log.stage('draw',len(frames),"Rendering\t") as stage:
+        ani = animation.FuncAnimation(fig,update,frames=frames,interval=60)
 
-    # Save animation and close the figure
-    ani.save(outfile)
-    if verbose: bar3.next(); bar3.finish()
+        # Save animation and close the figure
+        ani.save(outfile,writer=ffmpeg_writer(1000/60,qp),progress_callback=lambda i,n: stage.advance())
     plt.close(fig)
     plt.ion()
@@ -1,9 +1,19 @@
 import numpy as np
+import numpy.polynomial.polynomial as npp
+import numpy.polynomial.chebyshev as npc
+from scipy.optimize import linear_sum_assignment
 import yroots as yr
-import matplotlib.pyplot as plt
-import matplotlib.animation as ani
+import contourpy
 import os
-from progress.bar import IncrementalBar
+import sys
+from functools import partial
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir))
+from eigenfun.cache import digest
+from eigenfun.segments import render_parallel
+from eigenfun.framepipe import encoder_args, ffmpeg_writer
+from eigenfun.instrument import instrument
 # import beampy as bp
 # doc = bp.document()
 
@@ -12,37 +22,231 @@ from progress.bar import IncrementalBar
 
 # doc._theme['document']['external_app'] = {"dvisvgm": "auto",}
 
-plt.style.use('seaborn')
+def _pyplot():
+    """Imports pyplot and sets the style of the plots, on the first plot
+    rather than at import (the style is called seaborn-v0_8 in newer
+    matplotlib)"""
+    import matplotlib.pyplot as plt
+    plt.style.use('seaborn' if 'seaborn' in plt.style.available else 'seaborn-v0_8')
+    return plt
 
-Writer = ani.writers['ffmpeg']
-writer = Writer(fps=30, metadata=dict(artist='Me'), bitrate=1800)
+def _writer(qp=None):
+    return ffmpeg_writer(30, qp, bitrate=1800, metadata=dict(artist='Me'))
 
-def eval_homotopy(P,Q,T,X,Y,verbose=False):
+class HomotopyFrames:
+    """Frames of a linear homotopy on a grid, (1-T[j])*p + T[j]*q, computed
+    in float32 only when indexed. p and q are the start and end polynomials
+    evaluated on the grid."""
+    def __init__(self,p,q,T):
+        self.p = np.asarray(p,dtype=np.float32)
+        self.d = np.asarray(q,dtype=np.float32)-self.p
+        self.T = np.asarray(T,dtype=np.float32)
+
+    def __len__(self):
+        return len(self.T)
+
+    def __getitem__(self,j):
+        return self.p+self.T[j]*self.d
+
+def eval_homotopy(P,Q,T,X,Y,verbose=False,mode='direct',solver='solve',workers=None,cache=None):
+    """mode is 'direct' to evaluate the blended polynomials on the grid for
+    every t, 'blend' to evaluate P and Q on the grid once and blend all frames
+    in one vectorized step, or 'lazy' to return HomotopyFrames that blend each
+    frame when it is drawn. solver is 'solve' to find the roots with polysolve
+    for every t (see solve_frames for workers and cache), or 'track' to follow
+    them along the homotopy (see track_roots)"""
     p1, p2 = P
     q1, q2 = Q
     if 'MultiCheb' in str(type(p1)):
         MultiX = yr.MultiCheb
     else: MultiX = yr.MultiPower
     pts = np.array([X.flatten(),Y.flatten()]).T
-    arr1 = np.empty((len(T),*X.shape))
-    arr2 = np.empty((len(T),*X.shape))
-    roots = []
+    # the homotopy is linear in the coefficients, so its values on the grid
+    # are the same blend of the values of P and Q
+    if mode == 'blend':
+        t = np.asarray(T)[:,np.newaxis,np.newaxis]
+        P1,Q1 = p1(pts).reshape(X.shape),q1(pts).reshape(X.shape)
+        P2,Q2 = p2(pts).reshape(X.shape),q2(pts).reshape(X.shape)
+        arr1 = (1-t)*P1+t*Q1
+        arr2 = (1-t)*P2+t*Q2
+    elif mode == 'lazy':
+        arr1 = HomotopyFrames(p1(pts).reshape(X.shape),q1(pts).reshape(X.shape),T)
+        arr2 = HomotopyFrames(p2(pts).reshape(X.shape),q2(pts).reshape(X.shape),T)
+    elif mode == 'direct':
+        arr1 = np.empty((len(T),*X.shape))
+        arr2 = np.empty((len(T),*X.shape))
+        for i,t in enumerate(T):
+            arr1[i] = MultiX((1-t)*p1.coeff+t*q1.coeff)(pts).reshape(X.shape)
+            arr2[i] = MultiX((1-t)*p2.coeff+t*q2.coeff)(pts).reshape(X.shape)
+    else:
+        raise ValueError(f"Unknown mode '{mode}'")
     xmin,xmax,ymin,ymax = X.min(),X.max(),Y.min(),Y.max()
-    if verbose: bar1 = IncrementalBar("Computing homotopy\t", max=len(T),suffix='%(percent)d%%')
-    for i,t in enumerate(T):
-        coeff1 = (1-t)*p1.coeff+t*q1.coeff
-        poly1 = MultiX(coeff1)
-        coeff2 = (1-t)*p2.coeff+t*q2.coeff
-        poly2 = MultiX(coeff2)
-        arr1[i] = poly1(pts).reshape(X.shape)
-        arr2[i] = poly2(pts).reshape(X.shape)
-        roots.append(rootfilter(yr.polysolve([poly1,poly2]),xmin,xmax,ymin,ymax))
-        if verbose: bar1.next()
-    if verbose: bar1.finish()
+    if solver == 'track':
+        tracks = track_roots(P,Q,T,verbose=verbose)
+        roots = [rootfilter(z[~np.isnan(z).any(axis=1)],xmin,xmax,ymin,ymax,tol=1e-8)
+                 for z in tracks]
+    elif solver == 'solve':
+        roots = [rootfilter(z,xmin,xmax,ymin,ymax)
+                 for z in solve_frames(P,Q,T,workers,cache,verbose)]
+    else:
+        raise ValueError(f"Unknown solver '{solver}'")
     return arr1,arr2,roots,T
 
-def rootfilter(roots,xmin=1.1,xmax=1.1,ymin=1.1,ymax=1.1):
-    realmask = (np.abs(roots[:,0].imag)<1e-16)&(np.abs(roots[:,1].imag)<1e-16)
+def _polysolve(system):
+    cheb,coeff1,coeff2 = system
+    MultiX = yr.MultiCheb if cheb else yr.MultiPower
+    return yr.polysolve([MultiX(coeff1),MultiX(coeff2)])
+
+def solve_frames(P,Q,T,workers=None,cache=None,verbose=False):
+    """Finds all common roots of the homotopy (1-t)*P + t*Q for each t in T
+    with polysolve.
+
+    workers is the number of processes the solves are spread over (serial if
+    None), the roots are returned in the order of T either way. cache is an
+    eigenfun.cache.Cache; the roots of each frame are looked up in and stored
+    to it keyed on the blended coefficients, so frames are never solved twice
+    for the same polynomials whatever the grid or colors.
+    """
+    p1, p2 = P
+    q1, q2 = Q
+    cheb = 'MultiCheb' in str(type(p1))
+    systems = [(cheb,(1-t)*p1.coeff+t*q1.coeff,(1-t)*p2.coeff+t*q2.coeff) for t in T]
+    keys = [digest('polysolve',*system) for system in systems]
+    roots = [None]*len(T) if cache is None else [cache.get(key) for key in keys]
+    todo = [i for i,z in enumerate(roots) if z is None]
+
+    # cached frames count as done but not as solved
+    stage = instrument(verbose).stage('solve',len(T),"Computing homotopy\t")
+    stage.goto(len(T)-len(todo))
+    pool = ProcessPoolExecutor(workers) if workers is not None and workers > 1 else None
+    try:
+        pending = [systems[i] for i in todo]
+        solved = pool.map(_polysolve,pending,chunksize=4) if pool else map(_polysolve,pending)
+        for i,z in zip(todo,solved):
+            roots[i] = z
+            if cache is not None: cache.set(keys[i],z)
+            stage.advance()
+    finally:
+        if pool is not None: pool.shutdown()
+    stage.finish(len(todo))
+    return roots
+
+class _Homotopy:
+    """Values, Jacobians and t-derivatives of the system (1-t)*P + t*Q at
+    complex points z (an array of shape (r,2)), from the coefficient arrays of
+    the polynomials (axis k of a coefficient array is the kth variable)"""
+    def __init__(self,P,Q):
+        cheb = 'MultiCheb' in str(type(P[0]))
+        self.val = npc.chebval2d if cheb else npp.polyval2d
+        der = npc.chebder if cheb else npp.polyder
+        self.P = [np.asarray(p.coeff) for p in P]
+        self.Q = [np.asarray(q.coeff) for q in Q]
+        self.dP = [(der(c,axis=0),der(c,axis=1)) for c in self.P]
+        self.dQ = [(der(c,axis=0),der(c,axis=1)) for c in self.Q]
+
+    def H(self,z,t):
+        x,y = z[:,0],z[:,1]
+        return np.stack([(1-t)*self.val(x,y,p)+t*self.val(x,y,q)
+                         for p,q in zip(self.P,self.Q)],axis=1)
+
+    def Ht(self,z):
+        x,y = z[:,0],z[:,1]
+        return np.stack([self.val(x,y,q)-self.val(x,y,p)
+                         for p,q in zip(self.P,self.Q)],axis=1)
+
+    def J(self,z,t):
+        x,y = z[:,0],z[:,1]
+        return np.stack([np.stack([(1-t)*self.val(x,y,dp)+t*self.val(x,y,dq)
+                                   for dp,dq in zip(dps,dqs)],axis=1)
+                         for dps,dqs in zip(self.dP,self.dQ)],axis=1)
+
+def _continue(h,z,t,dt,tol=1e-10,maxiter=5):
+    """One predictor-corrector step of the roots z from t to t+dt: an Euler
+    step along the path tangent followed by Newton iterations. Returns the new
+    roots, or None if the corrector fails or two paths collide."""
+    with np.errstate(all='ignore'):
+        try:
+            dz = -np.linalg.solve(h.J(z,t),h.Ht(z)[:,:,np.newaxis])[:,:,0]
+            z = z+dt*dz
+            for _ in range(maxiter):
+                step = -np.linalg.solve(h.J(z,t+dt),h.H(z,t+dt)[:,:,np.newaxis])[:,:,0]
+                z = z+step
+                if np.all(np.abs(step) <= tol*(1+np.abs(z))):
+                    break
+            else:
+                return None
+        except np.linalg.LinAlgError:
+            return None
+    if not np.all(np.isfinite(z)):
+        return None
+    if len(z) > 1:
+        D = np.abs(z[:,np.newaxis,:]-z[np.newaxis,:,:]).max(axis=2)
+        np.fill_diagonal(D,np.inf)
+        if D.min() < 1e-6:
+            return None
+    return z
+
+def track_roots(P,Q,T,hmin=1e-8,verbose=False):
+    """Tracks the common roots of the homotopy (1-t)*P + t*Q through the values
+    T with adaptive predictor-corrector continuation. The roots are found with
+    a full polysolve only at T[0], and again wherever continuation fails (a
+    step below hmin, diverging or colliding paths), in which case the new
+    roots are matched to the predicted ones.
+
+    Returns
+    -------
+    tracks : ndarray
+        Complex array of shape (len(T),r,2) where tracks[j,k] is root k at
+        T[j], consistently labeled across j, and nan where root k does not
+        exist
+    """
+    p1, p2 = P
+    q1, q2 = Q
+    if 'MultiCheb' in str(type(p1)):
+        MultiX = yr.MultiCheb
+    else: MultiX = yr.MultiPower
+    solve = lambda t: yr.polysolve([MultiX((1-t)*p1.coeff+t*q1.coeff),
+                                    MultiX((1-t)*p2.coeff+t*q2.coeff)]).reshape(-1,2)
+    h = _Homotopy(P,Q)
+
+    z = solve(T[0]).astype(complex)
+    labels = np.arange(len(z))
+    nlabels = len(z)
+    frames = [(labels,z)]
+    step = (T[-1]-T[0])/len(T)
+    stage = instrument(verbose).stage('solve',len(T),"Tracking roots\t")
+    stage.advance()
+    for t0,t1 in zip(T[:-1],T[1:]):
+        t = t0
+        while t < t1:
+            dt = min(step,t1-t)
+            znew = _continue(h,z,t,dt) if len(z) else z
+            if znew is not None:
+                z,t = znew,(t1 if dt == t1-t else t+dt)
+                step = 2*dt
+            elif dt > hmin:
+                step = dt/2
+            else:
+                # continuation failed, solve from scratch and relabel
+                w = solve(t1).astype(complex)
+                D = np.abs(z[:,np.newaxis,:]-w[np.newaxis,:,:]).max(axis=2)
+                r,c = linear_sum_assignment(D)
+                new = np.setdiff1d(np.arange(len(w)),c)
+                labels = np.concatenate((labels[r],nlabels+np.arange(len(new))))
+                nlabels += len(new)
+                z,t = w[np.concatenate((c,new))],t1
+                step = (t1-t0)
+        frames.append((labels,z))
+        stage.advance()
+    stage.finish()
+
+    tracks = np.full((len(T),nlabels,2),np.nan,dtype=complex)
+    for j,(labels,z) in enumerate(frames):
+        tracks[j,labels] = z
+    return tracks
+
+def rootfilter(roots,xmin=1.1,xmax=1.1,ymin=1.1,ymax=1.1,tol=1e-16):
+    realmask = (np.abs(roots[:,0].imag)<tol)&(np.abs(roots[:,1].imag)<tol)
     roots = roots[realmask].real
     intervalmask = (roots[:,0]>=xmin)&(roots[:,0]<=xmax)&(roots[:,1]>=ymin)&(roots[:,1]<=ymax)
     roots = roots[intervalmask]
@@ -59,6 +263,7 @@ def plot_start_end(P,Q,X,Y):
     p1,p2 = P
     q1,q2 = Q
     pts = np.array([X.flatten(),Y.flatten()]).T
+    plt = _pyplot()
     fig = plt.figure(figsize=(10,5))
     ax = plt.subplot(121)
     fig.subplots_adjust(left=0,right=1,bottom=0,top=1)
@@ -78,17 +283,82 @@ def plot_start_end(P,Q,X,Y):
     ax.set_aspect('equal')
     plt.show()
 
-def sigmoid_homotopy(P,Q,X,Y,verbose=False):
+def sigmoid_homotopy(P,Q,X,Y,verbose=False,mode='direct',solver='solve',workers=None,cache=None):
     t = np.linspace(0,1,300)
     beta = 2
     f = lambda t: 1/(1+(t/(1-t))**(-beta))
     T = f(t)
     T[0],T[-1] = 0,1
-    return eval_homotopy(P,Q,T,X,Y,verbose)
+    return eval_homotopy(P,Q,T,X,Y,verbose,mode,solver,workers,cache)
+
+def _zero_contour(X,Y,z):
+    points,offsets = contourpy.contour_generator(X,Y,z,line_type='ChunkCombinedOffset').lines(0)
+    if points[0] is None:
+        return np.empty((0,2),dtype=np.float32),np.zeros(1,dtype=np.int32)
+    return points[0].astype(np.float32),offsets[0].astype(np.int32)
+
+def zero_contours(X,Y,arr,workers=None,verbose=False):
+    """Extracts the zero level set of every frame arr[j] on the grid X,Y with
+    marching squares. Each frame's curves are stored compactly as a (points,
+    offsets) pair, curve k being points[offsets[k]:offsets[k+1]]; use
+    contour_segments to turn them into line segments. workers is the number
+    of processes the frames are spread over (serial if None)."""
+    stage = instrument(verbose).stage('contour',len(arr),"Contouring\t\t")
+    pool = ProcessPoolExecutor(workers) if workers is not None and workers > 1 else None
+    try:
+        frames = (arr[j] for j in range(len(arr)))
+        if pool is not None:
+            lines = pool.map(_zero_contour,repeat(X),repeat(Y),frames,chunksize=8)
+        else:
+            lines = map(_zero_contour,repeat(X),repeat(Y),frames)
+        contours = []
+        for line in lines:
+            contours.append(line)
+            stage.advance()
+    finally:
+        if pool is not None: pool.shutdown()
+    stage.finish()
+    return contours
 
-def animate_homotopy(P,Q,X,Y,filename=None,c1='C0',c2='C1',c='white',facecolor='black',verbose=False):
+def contour_segments(contour):
+    """Splits the (points,offsets) of one frame into a list of curves"""
+    points,offsets = contour
+    return np.split(points,offsets[1:-1])
+
+def animate_homotopy(P,Q,X,Y,filename=None,c1='C0',c2='C1',c='white',facecolor='black',verbose=False,
+        render_workers=None,mode='direct',solver='solve',workers=None,cache=None,lossless=False):
     if facecolor == 'white': c='black'
-    arr1,arr2,roots,T = sigmoid_homotopy(P,Q,X,Y,verbose)
+    arr1,arr2,roots,T = sigmoid_homotopy(P,Q,X,Y,verbose,mode,solver,workers,cache)
+    lines1 = zero_contours(X,Y,arr1,workers,verbose)
+    lines2 = zero_contours(X,Y,arr2,workers,verbose)
+
+    if filename is None:
+        i = 0
+        while os.path.exists(f"homotopy{i}.mp4"):
+            i += 1
+        filename = f"homotopy{i}.mp4"
+    if render_workers is not None and render_workers > 1:
+        render = partial(render_homotopy,X,Y,lines1,lines2,roots,c1=c1,c2=c2,c=c,facecolor=facecolor)
+        # the segments are joined and encoded like a serial render
+        render_parallel(render,2*len(T),filename,render_workers,
+                        encode=None if lossless else encoder_args(bitrate=1800))
+    else:
+        render_homotopy(X,Y,lines1,lines2,roots,filename,c1,c2,c,facecolor,verbose=verbose,
+                        lossless=lossless)
+    if verbose:
+        print(f'saving as {filename}')
+
+def render_homotopy(X,Y,lines1,lines2,roots,outfile,c1='C0',c2='C1',c='white',facecolor='black',
+        frames=None,verbose=False,lossless=False):
+    """Renders the homotopy forwards and then backwards from the zero contours
+    of both polynomials (see zero_contours) and the roots of every frame.
+    `frames` is the range of frames to render, all 2*len(roots) by default.
+    If lossless, the frames are encoded without loss (libx264 at quantizer 0)
+    instead of at 1800 kbps."""
+    frames = range(2*len(lines1)) if frames is None else frames
+    plt = _pyplot()
+    import matplotlib.animation as ani
+    from matplotlib.collections import LineCollection
 
     fig = plt.figure(figsize=(6,6),dpi=200)
     ax = plt.gca()
@@ -97,38 +367,24 @@ def animate_homotopy(P,Q,X,Y,filename=None,c1='C0',c2='C1',c='white',facecolor='
     ax.set_aspect('equal')
     ax.set_facecolor(facecolor)
 
-    # contours = [ax.contour(X,Y,arr1[0],levels=[0],colors=c1),
-    #             ax.contour(X,Y,arr2[0],levels=[0],colors=c2)]
+    linewidth = plt.rcParams['lines.linewidth']
+    contours = [ax.add_collection(LineCollection([],colors=c1,linewidths=linewidth)),
+                ax.add_collection(LineCollection([],colors=c2,linewidths=linewidth))]
     scatter = plt.scatter(roots[0][:,0],roots[0][:,1],c=c,s=15,zorder=3)
+    ax.set_xlim(X.min(),X.max())
+    ax.set_ylim(Y.min(),Y.max())
 
     def update(i):
-        global contours
-        if i < len(T): j = i
-        elif i >= len(T): j = len(T) - i - 1
-        try:
-            for contour in contours:
-                for obj in contour.collections:
-                    obj.remove()
-        except:
-            pass
-        contours = [ax.contour(X,Y,arr1[j],levels=[0],colors=c1),
-                    ax.contour(X,Y,arr2[j],levels=[0],colors=c2)]
+        if i < len(lines1): j = i
+        elif i >= len(lines1): j = len(lines1) - i - 1
+        contours[0].set_segments(contour_segments(lines1[j]))
+        contours[1].set_segments(contour_segments(lines2[j]))
         scatter.set_offsets(roots[j])
-        if verbose: bar2.next()
-
-    if verbose: bar2 = IncrementalBar("Rendering\t\t",max=2*len(T),suffix='%(percent)d%%')
 
-    animation = ani.FuncAnimation(fig,update,frames=2*len(T),interval=20)
-
-    if filename is None:
-        i = 0
-        while os.path.exists(f"homotopy{i}.mp4"):
-            i += 1
-        filename = f"homotopy{i}.mp4"
-    animation.save(filename,writer=writer)
-    if verbose:
-        bar2.finish()
-        print(f'saving as {filename}')
+    with instrument(verbose).stage('draw',len(frames),"Rendering\t\t") as stage:
+        animation = ani.FuncAnimation(fig,update,frames=frames,interval=20)
+        animation.save(outfile,writer=_writer(0 if lossless else None),progress_callback=lambda i,n: stage.advance())
+    plt.close(fig)
 
 # def animate_homotopy_html(P,Q,X,Y,filename=None,c1='C0',c2='C1',c='white',facecolor='black',verbose=False):
 #     if facecolor == 'white': c='black'